@@ -1,30 +1,43 @@
 from config import Config
-from elasticsearch import Elasticsearch
 from flask import Flask, request, current_app
 from flask_babel import Babel, lazy_gettext as _l
-from flask_bootstrap import Bootstrap
 from flask_login import LoginManager
 from flask_mail import Mail
-from flask_migrate import Migrate
-from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
+import importlib
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import logging
 from pathlib import Path
 import os
 from redis import Redis
 import rq
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.utils import cached_property
 
 
 babel = Babel()
-bootstrap = Bootstrap()
 db = SQLAlchemy()
 login = LoginManager()
 login.login_view = 'auth.login'
 login.login_message = _l('Please log in to access this page.')
 mail = Mail()
-migrate = Migrate()
-moment = Moment()
+
+# extensions only the web app uses. they are built on first access of app.bootstrap,
+# app.migrate or app.moment (module __getattr__), so worker processes, which never
+# touch them, skip importing them and alembic
+_web_extensions = {
+    'bootstrap': ('flask_bootstrap', 'Bootstrap'),
+    'migrate': ('flask_migrate', 'Migrate'),
+    'moment': ('flask_moment', 'Moment'),
+}
+
+
+def __getattr__(name):
+    if name not in _web_extensions:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    module, cls = _web_extensions[name]
+    extension = globals()[name] = getattr(importlib.import_module(module), cls)()
+    return extension
 
 
 @babel.localeselector
@@ -32,9 +45,66 @@ def get_locale():
     return request.accept_languages.best_match(current_app.config['LANGUAGES'])
 
 
+class Microblog(Flask):
+    '''
+    flask app whose service clients are built on first use, so a process that never
+    talks to elasticsearch or the task queue (e.g. most rq jobs) never builds them.
+    the attributes can still be assigned, e.g. to swap in test doubles.
+    '''
+    @cached_property
+    def redis(self):
+        return Redis.from_url(self.config['REDIS_URL'])
+
+    @cached_property
+    def elasticsearch(self):
+        es_url = self.config.get('ELASTICSEARCH_URL', None)
+        if not es_url:
+            return None
+        from elasticsearch import Elasticsearch
+        return Elasticsearch([es_url])
+
+    @cached_property
+    def task_queues(self):
+        rq_url = self.config.get('REDISTOGO_URL', self.config['REDIS_URL'])
+        rq_connection = Redis.from_url(rq_url)
+        return {
+            priority: rq.Queue(name, connection=rq_connection)
+            for priority, name in self.config['TASK_QUEUES'].items()
+        }
+
+    @cached_property
+    def task_queue(self):
+        return self.task_queues['default']
+
+
+def create_worker_app(config_class=Config):
+    '''
+    lightweight app for rq jobs (see app.tasks): the database, mail and templates
+    only. no blueprints, log files or email log handler; errors go to the worker's
+    stderr, which rq already captures.
+    '''
+    app = Microblog(__name__)
+    app.config.from_object(config_class)
+
+    db.init_app(app)
+    mail.init_app(app)
+    babel.init_app(app)
+    app.jinja_env.add_extension('pypugjs.ext.jinja.PyPugJSExtension')
+
+    app.logger.setLevel(logging.INFO)
+    return app
+
+
 def create_app(config_class=Config):
-    app = Flask(__name__)
+    from app import bootstrap, migrate, moment
+
+    app = Microblog(__name__)
     app.config.from_object(config_class)
+    if app.config['PROXY_COUNT']:
+        # client address and scheme from the X-Forwarded-For/Proto headers the
+        # proxies in front of the app append, trusting only that many of them
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_COUNT'],
+                                x_proto=app.config['PROXY_COUNT'])
 
     db.init_app(app)
     migrate.init_app(app, db)
@@ -45,12 +115,8 @@ def create_app(config_class=Config):
     babel.init_app(app)
     app.jinja_env.add_extension('pypugjs.ext.jinja.PyPugJSExtension')
 
-    es_url = app.config.get('ELASTICSEARCH_URL', None)
-    app.elasticsearch = Elasticsearch([es_url]) if es_url else None
-
-    app.redis = Redis.from_url(app.config['REDIS_URL'])
-    rq_url = app.config.get('REDISTOGO_URL', app.redis)
-    app.task_queue = rq.Queue('flask_blog-tasks', connection=Redis.from_url(rq_url))
+    from app import ratelimit
+    ratelimit.init_app(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
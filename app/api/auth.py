@@ -1,5 +1,7 @@
+from app import db
 from app.api.errors import error_response
 from app.models import User
+from flask import abort
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 
 
@@ -14,6 +16,8 @@ basic_auth = HTTPBasicAuth()
 def verify_password(username, password):
     user = User.query.filter_by(username=username).first()
     if user and user.check_password(password):
+        # stores the password hash if check_password upgraded it
+        db.session.commit()
         return user
 
 
@@ -26,11 +30,32 @@ def basic_auth_error(status):
 token_auth = HTTPTokenAuth()
 
 
+class TokenUser(object):
+    '''
+    stands in for the user of a verified token. the id is known from the token
+    lookup; the users row is only loaded once any other attribute is used. a user
+    deleted after their token was cached gets a 401 at that point.
+    '''
+    def __init__(self, id):
+        self.id = id
+        self._user = None
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if self._user is None:
+            self._user = User.query.get(self.id)
+            if self._user is None:
+                abort(token_auth_error(401))
+        return getattr(self._user, name)
+
+
 # flask-httpauth will user verify_token
 # decorated func when using token auth
 @token_auth.verify_token
 def verify_token(token):
-    return User.check_token(token) if token else None
+    user_id = User.check_token_id(token) if token else None
+    return TokenUser(user_id) if user_id is not None else None
 
 
 @token_auth.error_handler
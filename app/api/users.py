@@ -3,9 +3,29 @@ from app.api import bp
 from app.api.auth import token_auth
 from app.api.errors import bad_request
 from app.models import User
+from app.pagination import decode_cursor
 from flask import abort, jsonify, request, url_for
 
 
+def _user_collection(query, endpoint, **kwargs):
+    '''
+    paginates a collection of users. passing ?cursor= (empty for the first page)
+    switches from page numbers to keyset pagination on the user id, which skips
+    the OFFSET scan and only counts the collection when ?include_total=1 is given.
+    '''
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    if 'cursor' in request.args:
+        cursor = request.args['cursor'] or None
+        if cursor and decode_cursor(cursor, [User.id]) is None:
+            return bad_request('invalid cursor')
+        return jsonify(User.to_cursor_collection_dict(
+            query, [User.id], cursor, per_page, endpoint,
+            include_total=request.args.get('include_total', 0, type=int) == 1, **kwargs
+        ))
+    page = request.args.get('page', 1, type=int)
+    return jsonify(User.to_collection_dict(query, page, per_page, endpoint, **kwargs))
+
+
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
@@ -15,30 +35,21 @@ def get_user(id):
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 def get_users():
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(User.query, page, per_page, 'api.get_users')
-    return jsonify(data)
+    return _user_collection(User.query, 'api.get_users')
 
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
 @token_auth.login_required
 def get_followers(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followers, page, per_page, 'api.get_followers', id=id)
-    return jsonify(data)
+    return _user_collection(user.followers, 'api.get_followers', id=id)
 
 
 @bp.route('/users/<int:id>/followed', methods=['GET'])
 @token_auth.login_required
 def get_followed(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followed, page, per_page, 'api.get_followed', id=id)
-    return jsonify(data)
+    return _user_collection(user.followed, 'api.get_followed', id=id)
 
 
 @bp.route('/users', methods=['POST'])
@@ -27,6 +27,8 @@ def login():
 
         # for security only redirect when url is relative
         login_user(user, remember=form.remember_me.data)
+        # stores the password hash if check_password upgraded it
+        db.session.commit()
         next_page = request.args.get('next')
         if not next_page or url_parse(next_page).netloc != '':
             next_page = url_for('main.index')
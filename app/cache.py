@@ -0,0 +1,122 @@
+from collections import OrderedDict
+from flask import current_app
+import pickle
+import redis
+import threading
+import time
+
+
+class LRUCache(object):
+    '''
+    small thread safe in-process LRU with a per-entry ttl. used in front of redis
+    so hot keys are served without a network round-trip.
+    '''
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TwoLevelCache(object):
+    '''
+    read-through cache with an in-process LRU in front of redis. values are pickled
+    into redis with a ttl; the local copies expire sooner so other processes pick up
+    invalidations within the local ttl. redis errors degrade to cache misses.
+
+    sizes come from the app config on first use: <setting>_TTL (seconds in redis),
+    <setting>_LOCAL_TTL (seconds in the process LRU) and <setting>_SIZE (LRU entries).
+
+    :param prefix:      namespace of the redis keys
+    :param setting:     prefix of the config keys (e.g. - 'SEARCH_CACHE')
+    '''
+    def __init__(self, prefix, setting):
+        self.prefix = prefix
+        self.setting = setting
+        self._local = None
+
+    @property
+    def ttl(self):
+        return current_app.config[f'{self.setting}_TTL']
+
+    @property
+    def local(self):
+        if self._local is None:
+            self._local = LRUCache(
+                current_app.config[f'{self.setting}_SIZE'],
+                current_app.config[f'{self.setting}_LOCAL_TTL'],
+            )
+        return self._local
+
+    def _key(self, key):
+        return f'{self.prefix}:{key}'
+
+    def get(self, key):
+        return self.get_many([key])[key]
+
+    def get_many(self, keys):
+        '''
+        :param keys:        list of cache keys
+        :returns:           dict -> {key: value or None} with an entry for every key
+        '''
+        found = {key: self.local.get(key) for key in keys}
+        missing = [key for key, value in found.items() if value is None]
+        if missing:
+            try:
+                values = current_app.redis.mget([self._key(key) for key in missing])
+            except redis.exceptions.RedisError:
+                values = [None] * len(missing)
+            for key, value in zip(missing, values):
+                if value is not None:
+                    found[key] = pickle.loads(value)
+                    self.local.set(key, found[key])
+        return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, mapping):
+        for key, value in mapping.items():
+            self.local.set(key, value)
+        try:
+            pipe = current_app.redis.pipeline(transaction=False)
+            for key, value in mapping.items():
+                pipe.set(self._key(key), pickle.dumps(value), ex=self.ttl)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            pass
+
+    def delete(self, *keys):
+        for key in keys:
+            self.local.delete(key)
+        try:
+            current_app.redis.delete(*[self._key(key) for key in keys])
+        except redis.exceptions.RedisError:
+            pass
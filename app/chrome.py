@@ -0,0 +1,30 @@
+from app.cache import TwoLevelCache
+from flask import g
+from flask_login import current_user
+
+
+# what base.pug shows around every page: unread message count and tasks in
+# progress, per user (see User.chrome_state). dropped by invalidate on changes.
+chrome_cache = TwoLevelCache('chrome', 'CHROME_CACHE')
+
+
+def get():
+    '''
+    the chrome of the current user, loaded at most once per request and served from
+    chrome_cache across requests.
+
+    :returns:           dict -> {'new_messages': int,
+                                 'tasks': lst({'id', 'description', 'progress'})}
+    '''
+    if 'chrome' not in g:
+        state = chrome_cache.get(current_user.id)
+        if state is None:
+            state = current_user.chrome_state()
+            chrome_cache.set(current_user.id, state)
+        g.chrome = state
+    return g.chrome
+
+
+def invalidate(user_id):
+    ''' drops a user's cached chrome, e.g. after a message arrives or a task moves on '''
+    chrome_cache.delete(user_id)
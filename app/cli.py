@@ -1,5 +1,6 @@
 import click
 import os
+import time
 
 
 def register(app):
@@ -32,3 +33,67 @@ def register(app):
         ''' Compile all languages. '''
         if os.system('pybabel compile -d app/translations'):
             raise RuntimeError('compile command failed')
+
+    @app.cli.group()
+    def last_seen():
+        ''' Buffered last seen commands. '''
+        pass
+
+    @last_seen.command()
+    def flush():
+        ''' Write buffered last seen times to the database. '''
+        from app.models import User
+        click.echo(f'{User.flush_last_seen()} users updated')
+
+    @app.cli.group()
+    def messages():
+        ''' Private message commands. '''
+        pass
+
+    @messages.command()
+    def reconcile():
+        ''' Recount unread messages and fix drifted counters. '''
+        from app.models import User
+        click.echo(f'{User.reconcile_unread_counts()} counters corrected')
+
+    @app.cli.group()
+    def notifications():
+        ''' Notification commands. '''
+        pass
+
+    @notifications.command()
+    @click.option('--days', type=int, help='Retention in days, NOTIFICATION_RETENTION by default.')
+    def sweep(days):
+        ''' Delete notifications older than the retention period. '''
+        from app.models import Notification
+        days = days or app.config['NOTIFICATION_RETENTION']
+        click.echo(f'{Notification.sweep(time.time() - days * 24 * 3600)} notifications deleted')
+
+    @app.cli.group()
+    def search():
+        ''' Search index commands. '''
+        pass
+
+    @search.command()
+    def replay():
+        ''' Requeue search index batches that exhausted their retries. '''
+        from app.search import replay_dead_letters
+        click.echo(f'{replay_dead_letters()} batches requeued')
+
+    @search.command()
+    @click.argument('table')
+    @click.option('--batch-size', type=int, help='Rows per _bulk request.')
+    @click.option('--workers', type=int, help='Concurrent _bulk requests.')
+    @click.option('--resume', is_flag=True, help='Continue from the last checkpoint.')
+    @click.option('--new-index', is_flag=True, help='Build a fresh index and swap the alias.')
+    def reindex(table, batch_size, workers, resume, new_index):
+        ''' Rebuild the search index of a table. '''
+        from app.models import SearchableMixin
+        models = {cls.__tablename__: cls for cls in SearchableMixin.__subclasses__()}
+        if table not in models:
+            raise click.BadParameter(f'choose from {", ".join(models)}', param_hint='table')
+
+        def progress(indexed, total):
+            click.echo(f'{indexed}/{total} rows indexed')
+
+        models[table].reindex(batch_size, workers, resume, new_index, progress)
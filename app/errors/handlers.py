@@ -1,6 +1,7 @@
 from app import db
 from app.errors import bp
 from app.api.errors import error_response as api_error_response
+from app.passwords import PasswordHashBusy
 from flask import render_template, request
 
 
@@ -25,3 +26,21 @@ def internal_error(error):
     if wants_json_response():
         return api_error_response(500)
     return render_template('errors/500.pug'), 500
+
+
+# too many password checks already waiting for the hashing pool
+@bp.app_errorhandler(PasswordHashBusy)
+def password_hash_busy(error):
+    if wants_json_response():
+        return api_error_response(503, 'too many login attempts, try again shortly'), \
+            {'Retry-After': '1'}
+    return render_template('errors/503.pug'), 503, {'Retry-After': '1'}
+
+
+# a rate limit of app.ratelimit ran out
+@bp.app_errorhandler(429)
+def too_many_requests(error):
+    headers = {'Retry-After': str(error.retry_after)}
+    if wants_json_response():
+        return api_error_response(429, 'rate limit exceeded, try again later'), headers
+    return render_template('errors/429.pug', retry_after=error.retry_after), 429, headers
@@ -0,0 +1,119 @@
+from flask import current_app
+import redis
+
+
+# each user's followed ids live in a redis set. the set always holds the marker 0
+# (no user has that id), so a user who follows nobody still has a warm set and a
+# missing key only ever means the set was not loaded from the database yet.
+#
+# every follow or unfollow bumps the user's version (KEYS[2]), warm set or not.
+# a load only writes the set if the version is still the one read before the
+# database was queried, so a follow committed in between can't be overwritten by
+# the stale rows.
+_ADD = '''
+redis.call('incr', KEYS[2])
+redis.call('expire', KEYS[2], ARGV[2])
+if redis.call('exists', KEYS[1]) == 1 then
+    redis.call('sadd', KEYS[1], ARGV[1])
+end
+return 0
+'''
+
+_REMOVE = '''
+redis.call('incr', KEYS[2])
+redis.call('expire', KEYS[2], ARGV[2])
+redis.call('srem', KEYS[1], ARGV[1])
+return 0
+'''
+
+# returns {1, flag per id in ARGV} for a warm set, {0, version} for a cold one
+_MEMBERS = '''
+if redis.call('exists', KEYS[1]) == 0 then
+    return {0, redis.call('get', KEYS[2]) or ''}
+end
+local result = {1}
+for i = 1, #ARGV do
+    result[i + 1] = redis.call('sismember', KEYS[1], ARGV[i])
+end
+return result
+'''
+
+# ARGV: version read with the cold set, ttl, then the followed ids
+_LOAD = '''
+if (redis.call('get', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('del', KEYS[1])
+redis.call('sadd', KEYS[1], 0)
+for i = 3, #ARGV, 1000 do
+    redis.call('sadd', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+redis.call('expire', KEYS[1], ARGV[2])
+return 1
+'''
+
+
+def _keys(user_id):
+    return [f'following:{user_id}', f'following:{user_id}:version']
+
+
+def following_among(user_id, ids):
+    '''
+    which of the users in ids a user follows, in one round-trip and without sql.
+
+    :param user_id:     id of the follower
+    :param ids:         ids of the users to check
+    :returns:           tuple -> (set of the followed ids among ids, None) for a warm
+                        set, or (None, version) for a cold one, to be passed to load
+                        with the followed ids read from the database. (None, None)
+                        when redis is down
+    '''
+    ids = list(ids)
+    members = current_app.redis.register_script(_MEMBERS)
+    try:
+        result = members(keys=_keys(user_id), args=ids)
+    except redis.exceptions.RedisError:
+        return None, None
+    if not result[0]:
+        return None, result[1]
+    return {id for id, flag in zip(ids, result[1:]) if flag}, None
+
+
+def load(user_id, version, followed_ids):
+    '''
+    fills a user's cold set with every id they follow, unless a follow or unfollow
+    happened since version was read.
+    '''
+    fill = current_app.redis.register_script(_LOAD)
+    try:
+        fill(keys=_keys(user_id),
+             args=[version, current_app.config['FOLLOW_CACHE_TTL']] + list(followed_ids))
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('follow graph load failed for user %s', user_id)
+
+
+def _update(script, user_id, followed_id):
+    update = current_app.redis.register_script(script)
+    try:
+        update(keys=_keys(user_id), args=[followed_id, current_app.config['FOLLOW_CACHE_TTL']])
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('follow graph update failed for user %s', user_id)
+        forget(user_id)
+
+
+def add(user_id, followed_id):
+    ''' write-through of a committed follow '''
+    _update(_ADD, user_id, followed_id)
+
+
+def remove(user_id, followed_id):
+    ''' write-through of a committed unfollow '''
+    _update(_REMOVE, user_id, followed_id)
+
+
+def forget(user_id):
+    # a set that missed an update must not answer again; the next read reloads it
+    try:
+        current_app.redis.delete(*_keys(user_id))
+    except redis.exceptions.RedisError:
+        pass
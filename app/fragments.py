@@ -0,0 +1,37 @@
+from app.cache import TwoLevelCache
+from app.models import User
+from flask import g, render_template
+from markupsafe import Markup
+
+
+# rendered _post.pug, per post. a post's html only changes with its language (set
+# later by the background detection), its author's name and avatar, and the
+# locale it's rendered for, so those are part of the key and nothing is invalidated
+post_cache = TwoLevelCache('fragment:post', 'POST_FRAGMENT_CACHE')
+
+
+def _key(post):
+    author = post.author
+    return f'{post.id}:{post.language}:{author.avatar_hash}:{g.locale}:{author.username}'
+
+
+def render_posts(posts):
+    '''
+    the html of a page of posts, each rendered by _post.pug. the fragments are
+    looked up together in post_cache and only the missing ones are rendered.
+
+    :param posts:       list of posts, with their authors loaded (see Post.with_authors)
+    :returns:           Markup
+    '''
+    keys = [_key(post) for post in posts]
+    fragments = post_cache.get_many(keys)
+    missing = [(key, post) for key, post in zip(keys, posts) if fragments[key] is None]
+    if missing:
+        avatars = User.avatar_urls([post.author for _, post in missing], 70)
+        rendered = {
+            key: render_template('_post.pug', post=post, avatars=avatars)
+            for key, post in missing
+        }
+        post_cache.set_many(rendered)
+        fragments.update(rendered)
+    return Markup(''.join(fragments[key] for key in keys))
@@ -0,0 +1,89 @@
+from app import db
+from datetime import datetime
+from flask import current_app
+import redis
+import time
+
+
+# redis hash of user_id -> epoch seconds of the latest request not yet written to users
+BUFFER_KEY = 'last_seen'
+
+# per-process memo of the last time each user was recorded, so requests inside the
+# resolution window skip redis entirely. cleared wholesale once it grows too large.
+_recorded = {}
+_RECORDED_MAX = 10000
+
+# deletes the fields that still hold the flushed value. ARGV: user_id, value, ...
+_CLEAR = '''
+for i = 1, #ARGV, 2 do
+    if redis.call('hget', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        redis.call('hdel', KEYS[1], ARGV[i])
+    end
+end
+return 0
+'''
+
+
+def record(user):
+    '''
+    buffers the time of an authenticated request instead of committing it to the
+    users table. writes closer together than LAST_SEEN_RESOLUTION seconds are skipped.
+    if redis is unavailable the value is written straight to the database, still
+    bounded by the resolution.
+
+    :param user:        the current user
+    :returns:
+    '''
+    now = time.time()
+    resolution = current_app.config['LAST_SEEN_RESOLUTION']
+    if now - _recorded.get(user.id, 0) < resolution:
+        return
+    if len(_recorded) >= _RECORDED_MAX:
+        _recorded.clear()
+    _recorded[user.id] = now
+    try:
+        current_app.redis.hset(BUFFER_KEY, user.id, now)
+    except redis.exceptions.RedisError:
+        if user.last_seen is None or \
+                (datetime.utcnow() - user.last_seen).total_seconds() >= resolution:
+            user.last_seen = datetime.utcfromtimestamp(now)
+            db.session.commit()
+
+
+def get(user):
+    '''
+    returns the freshest known last seen time of a user: the buffered value if one
+    is waiting to be flushed, otherwise the users.last_seen column.
+    '''
+    try:
+        buffered = current_app.redis.hget(BUFFER_KEY, user.id)
+    except redis.exceptions.RedisError:
+        buffered = None
+    if buffered is None:
+        return user.last_seen
+    return datetime.utcfromtimestamp(float(buffered))
+
+
+def pending():
+    '''
+    reads every value waiting in the buffer without taking it out. the flush removes
+    them with clear once they are committed, so a failed flush loses nothing.
+
+    :returns:           dict -> {user_id: epoch seconds} as stored in the buffer
+    '''
+    return {int(id): ts for id, ts in current_app.redis.hgetall(BUFFER_KEY).items()}
+
+
+def clear(flushed):
+    '''
+    removes the flushed values from the buffer. a user recorded again after the
+    buffer was read keeps the newer value for the next flush.
+
+    :param flushed:     dict returned by pending, after its values were committed
+    :returns:
+    '''
+    script = current_app.redis.register_script(_CLEAR)
+    items = list(flushed.items())
+    for start in range(0, len(items), 1000):
+        script(keys=[BUFFER_KEY],
+               args=[arg for item in items[start:start + 1000] for arg in item])
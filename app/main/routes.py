@@ -1,56 +1,71 @@
-from app import db
+from app import chrome, db, fragments, last_seen, push, timeline
+from app.api.errors import bad_request
 from app.main import bp
 from app.main.forms import (
     EditProfileForm, EmptyForm,
     PostForm, SearchForm, MessageForm
 )
-from app.models import Post, User, Message, Notification
-from app.translate import detect_language, translate
-from datetime import datetime
+from app.models import Post, User, Message, Task
+from app.pagination import paginate_keyset
+from app.translate import guess_language, translate, translate_batch
 from flask import (
-    flash, redirect, g, jsonify, current_app,
-    render_template, request, url_for,
+    abort, flash, redirect, g, jsonify, current_app,
+    render_template, request, send_file, url_for, Response,
 )
 from flask_babel import _, get_locale
 from flask_login import current_user, login_required
+import os
+import redis
+from uuid import uuid4
 
 
 @bp.before_app_request
 def before_request():
-    if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+    if current_user.is_authenticated and request.endpoint != 'static':
+        last_seen.record(current_user)
         # 'g' is a container provided by flask that exists for the
         #  lifetime of the request. it is specific to each request.
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
 
+@bp.app_context_processor
+def inject_chrome():
+    # base.pug calls get_chrome() for the navbar badge and task alerts, the pages
+    # listing posts render_posts(), messages.pug avatar_urls() for their authors
+    return {
+        'get_chrome': chrome.get,
+        'render_posts': fragments.render_posts,
+        'avatar_urls': User.avatar_urls,
+    }
+
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        language = detect_language(form.post.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
-        post = Post(body=form.post.data, author=current_user, language=language)
+        # an unrecognised language stays NULL and is detected by a background job
+        post = Post(body=form.post.data, author=current_user,
+                    language=guess_language(form.post.data))
         db.session.add(post)
         db.session.commit()
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
 
-    page = request.args.get('page', 1, type=int)
-    posts = (
-        current_user.followed_posts()
-                    .paginate(
-                        page=page, error_out=False,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                    )
-    )
-    next_url = url_for('main.index', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) if posts.has_prev else None
+    cursor = request.args.get('cursor')
+    per_page = current_app.config['POSTS_PER_PAGE']
+    posts = current_user.timeline_posts(cursor, per_page)
+    if posts is None:
+        # timeline is cold: serve this page from the database and warm it in the background
+        posts = paginate_keyset(
+            Post.with_authors(current_user.followed_posts()), [Post.timestamp, Post.id],
+            cursor, per_page,
+        )
+        timeline.request_rebuild(current_user.id)
+    next_url = url_for('main.index', cursor=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for('main.index', cursor=posts.prev_cursor) if posts.has_prev else None
     return render_template(
         'index.pug',
         title=_('Home Page'), form=form, posts=posts.items,
@@ -61,16 +76,12 @@ def index():
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    posts = (
-        Post.query.order_by(Post.timestamp.desc())
-                  .paginate(
-                      page=page, error_out=False,
-                      per_page=current_app.config['POSTS_PER_PAGE'],
-                  )
+    posts = paginate_keyset(
+        Post.with_authors(Post.query), [Post.timestamp, Post.id],
+        request.args.get('cursor'), current_app.config['POSTS_PER_PAGE'],
     )
-    next_url = url_for('main.explore', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) if posts.has_prev else None
+    next_url = url_for('main.explore', cursor=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for('main.explore', cursor=posts.prev_cursor) if posts.has_prev else None
     return render_template(
         'index.pug',
         title=_('Explore'), posts=posts.items,
@@ -82,17 +93,13 @@ def explore():
 @login_required
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    posts = (
-        user.posts.order_by(Post.timestamp.desc())
-                  .paginate(
-                      page=page, error_out=False,
-                      per_page=current_app.config['POSTS_PER_PAGE'],
-                  )
+    posts = paginate_keyset(
+        user.posts, [Post.timestamp, Post.id],
+        request.args.get('cursor'), current_app.config['POSTS_PER_PAGE'],
     )
-    next_url = url_for('main.user', username=user.username, page=posts.next_num) \
+    next_url = url_for('main.user', username=user.username, cursor=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.user', username=user.username, page=posts.prev_num) \
+    prev_url = url_for('main.user', username=user.username, cursor=posts.prev_cursor) \
         if posts.has_prev else None
     form = EmptyForm()
     return render_template(
@@ -178,6 +185,36 @@ def translate_text():
     })
 
 
+@bp.route('/translate/batch', methods=['POST'])
+@login_required
+def translate_batch_text():
+    '''
+    translates every post shown on a page in one round-trip. expects json:
+    {'dest_language': 'es', 'items': [{'id': ..., 'text': ..., 'source_language': ...}]}
+    and answers {'translations': {id: text}}, or 400 for anything else.
+    '''
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return bad_request('must be a json object')
+    if data.get('dest_language') not in current_app.config['LANGUAGES']:
+        return bad_request('dest_language must be one of the supported languages')
+    items = data.get('items')
+    if not isinstance(items, list) or len(items) > current_app.config['POSTS_PER_PAGE']:
+        return bad_request(
+            f'items must be a list of at most {current_app.config["POSTS_PER_PAGE"]} objects')
+    for item in items:
+        if not (isinstance(item, dict) and isinstance(item.get('id'), (int, str))
+                and isinstance(item.get('text'), str)
+                and isinstance(item.get('source_language'), str)):
+            return bad_request('every item must have an id, a text and a source_language')
+    texts = translate_batch(
+        [(item['text'], item['source_language']) for item in items],
+        data['dest_language'],
+    )
+    # json keys are strings anyway; str() also keeps mixed int and str ids sortable
+    return jsonify({'translations': {str(item['id']): text for item, text in zip(items, texts)}})
+
+
 @bp.route('/search')
 @login_required
 def search():
@@ -189,6 +226,7 @@ def search():
         g.search_form.q.data, page,
         current_app.config['POSTS_PER_PAGE']
     )
+    Post.load_authors(posts)
     next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
         if total > page * current_app.config['POSTS_PER_PAGE'] else None
     prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
@@ -222,7 +260,7 @@ def send_message(recipient):
             body=form.message.data,
         )
         db.session.add(msg)
-        user.add_notification('unread_message_count', user.new_messages())
+        user.add_notification('unread_message_count', user.add_unread_message())
         db.session.commit()
         flash(_('Your message has been sent.'))
         return redirect(url_for('main.user', username=recipient))
@@ -237,22 +275,17 @@ def send_message(recipient):
 @bp.route('/message')
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.utcnow()
+    current_user.read_messages()
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
 
-    page = request.args.get('page', 1, type=int)
-    messages = (
-        current_user.messages_received
-                    .order_by(Message.timestamp.desc())
-                    .paginate(
-                        page=page, error_out=False,
-                        per_page=current_app.config['POSTS_PER_PAGE']
-                    )
+    messages = paginate_keyset(
+        current_user.messages_received, [Message.timestamp, Message.id],
+        request.args.get('cursor'), current_app.config['POSTS_PER_PAGE'],
     )
-    next_url = url_for('main.messages', page=messages.next_num) \
+    next_url = url_for('main.messages', cursor=messages.next_cursor) \
         if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
+    prev_url = url_for('main.messages', cursor=messages.prev_cursor) \
         if messages.has_prev else None
 
     return render_template(
@@ -262,19 +295,49 @@ def messages():
     )
 
 
+def _notifications_since(since):
+    # answered from the user's latest-state hash; the database only fills it
+    notifications = push.latest(current_user.id)
+    if notifications is None:
+        notifications = [n.to_dict() for n in current_user.notifications]
+        push.fill(current_user.id, notifications)
+    return sorted((n for n in notifications if n['timestamp'] > since),
+                  key=lambda n: n['timestamp'])
+
+
 @bp.route('/notifications')
 @login_required
 def notifications():
+    ''' polling fallback of notification_stream '''
     since = request.args.get('since', 0.0, type=float)
-    notifications = (
-        current_user.notifications.filter(Notification.timestamp > since)
-                                  .order_by(Notification.timestamp.asc())
+    return jsonify(_notifications_since(since))
+
+
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    '''
+    server-sent events: the notifications newer than Last-Event-ID (or ?since=),
+    then every new one as it is published. an idle stream costs no database queries.
+    answers 503 when redis is down so the client falls back to polling.
+    '''
+    since = request.headers.get('Last-Event-ID', type=float) or \
+        request.args.get('since', 0.0, type=float)
+    try:
+        pubsub = push.subscribe(current_user.id)
+    except redis.exceptions.RedisError:
+        return '', 503
+    backlog = _notifications_since(since)
+    events = push.stream(
+        pubsub, backlog,
+        current_app.config['NOTIFICATION_HEARTBEAT'],
+        current_app.config['NOTIFICATION_STREAM_TIMEOUT'],
     )
-    return jsonify([{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp,
-    } for n in notifications])
+    return Response(events, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # nginx would otherwise buffer the stream
+        'X-Accel-Buffering': 'no',
+    })
 
 
 @bp.route('/export_posts')
@@ -283,6 +346,27 @@ def export_posts():
     if current_user.get_task_in_progress('export_posts'):
         flash(_('An export task is currently in progress'))
     else:
-        current_user.launch_task('export_posts', _('Exporting posts...'))
+        # the job id is chosen here so the download link can be built in this request;
+        # the worker app has no routes to build urls with
+        task_id = str(uuid4())
+        current_user.launch_task(
+            'export_posts', _('Exporting posts...'),
+            url_for('main.download_export', task_id=task_id, _external=True),
+            job_id=task_id,
+        )
         db.session.commit()
     return redirect(url_for('main.user', username=current_user.username))
+
+
+@bp.route('/export_posts/<task_id>')
+@login_required
+def download_export(task_id):
+    ''' serves a finished export. conditional=True answers Range and If-None-Match requests '''
+    task = Task.query.filter_by(id=task_id, user=current_user, name='export_posts').first_or_404()
+    path = task.get_export_path()
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(
+        path, mimetype='application/gzip', as_attachment=True,
+        attachment_filename='posts.ndjson.gz', conditional=True,
+    )
@@ -1,35 +1,61 @@
-from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app import chrome, db, follow_graph, last_seen, login, passwords, push, timeline
+from app.cache import TwoLevelCache
+from app.pagination import KeysetPagination, decode_cursor, paginate_keyset
+from app.search import (
+    bulk, cached_query_index, create_index, dead_letter, get_backend, row_cache,
+    delete_action, enqueue_bulk, index_action, swap_alias,
+)
+from app.search_backends import register_fulltext
+from app.translate import queue_detection
 import base64
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from flask import current_app, url_for
 from flask_login import UserMixin
-from hashlib import md5
+from hashlib import md5, sha256
 import json
 import jwt
 import os
 import redis
 import rq
+from rq.serializers import DefaultSerializer
+from sqlalchemy.orm.attributes import set_committed_value
 from time import time
-from werkzeug.security import generate_password_hash, check_password_hash
+
+
+def gravatar_hash(email):
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
+# api token hash -> (user id, expiration), see User.check_token_id
+token_cache = TwoLevelCache('auth:token', 'TOKEN_CACHE')
 
 
 # creates a self-referential many-to-many relationship to link
 # instances of the same class -> 'User' no need to declare
 # as model bc it is an auxiliary table and has no other use
+# the primary key serves a user's followed list and is_following, the reverse index
+# their followers; both cover the query, so the table itself is never read
 followers = db.Table(
     'followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('users.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('users.id')),
+    db.Column('follower_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
+    db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id'),
 )
 
 
 class PaginatedAPIMixin(object):
-    @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+    @classmethod
+    def to_dicts(cls, items):
+        ''' serializes a page of items. models can override this to batch lookups '''
+        return [item.to_dict() for item in items]
+
+    @classmethod
+    def to_collection_dict(cls, query, page, per_page, endpoint, **kwargs):
         resources = query.paginate(page, per_page, False)
         data = {
-            'items': [item.to_dict() for item in resources.items],
+            'items': cls.to_dicts(resources.items),
             'meta': {
                 'page': page,
                 'per_page': per_page,
@@ -53,6 +79,49 @@ class PaginatedAPIMixin(object):
         }
         return data
 
+    @classmethod
+    def to_cursor_collection_dict(cls, query, columns, cursor, per_page, endpoint,
+                                  include_total=False, **kwargs):
+        '''
+        keyset paginated counterpart of to_collection_dict. the meta section carries
+        cursors instead of page numbers and the total is only counted on request.
+
+        :param query:           sqlalchemy query of the collection
+        :param columns:         unique sort key of the collection (e.g. - [User.id])
+        :param cursor:          cursor from a previous page or None for the first page
+        :param per_page:        results per page
+        :param endpoint:        endpoint used to build the links
+        :param include_total:   adds meta.total_items, which costs a COUNT(*)
+        :returns:               dict -> items, meta and links of the page
+        '''
+        resources = paginate_keyset(query, columns, cursor, per_page, descending=False)
+        data = {
+            'items': cls.to_dicts(resources.items),
+            'meta': {
+                'per_page': per_page,
+                'cursor': cursor,
+                'next_cursor': resources.next_cursor,
+                'prev_cursor': resources.prev_cursor,
+            },
+            'links': {
+                'self': url_for(
+                            endpoint, cursor=cursor or '',
+                            per_page=per_page, **kwargs
+                        ),
+                'next': url_for(
+                            endpoint, cursor=resources.next_cursor,
+                            per_page=per_page, **kwargs
+                        ) if resources.has_next else None,
+                'prev': url_for(
+                            endpoint, cursor=resources.prev_cursor,
+                            per_page=per_page, **kwargs
+                        ) if resources.has_prev else None,
+            }
+        }
+        if include_total:
+            data['meta']['total_items'] = query.order_by(None).count()
+        return data
+
 
 class User(PaginatedAPIMixin, UserMixin, db.Model):
     __tablename__ = 'users'
@@ -61,11 +130,16 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
     password_hash = db.Column(db.String(128))
+    # md5 hex digest of the lowercased email, the gravatar id. kept by _set_email
+    avatar_hash = db.Column(db.String(32))
     about_me = db.Column(db.String(140))
-    token = db.Column(db.String(32), index=True, unique=True)
+    # sha256 hex digest of the api token, see get_token
+    token = db.Column(db.String(64), index=True, unique=True)
     token_expiration = db.Column(db.DateTime)
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
     last_message_read_time = db.Column(db.DateTime)
+    # messages received since last_message_read_time, see add_unread_message
+    unread_message_count = db.Column(db.Integer, default=0, server_default='0')
     created_on = db.Column(db.DateTime, server_default=db.func.now())
     updated_on = db.Column(
         db.DateTime,
@@ -97,39 +171,126 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         return f'<User {self.username}>'
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        '''
+        verifies a password on the hashing pool (see app.passwords). a hash made with
+        outdated parameters is replaced while the password is at hand; the caller
+        commits it.
+        '''
+        if not self.password_hash or not passwords.check_password(self.password_hash, password):
+            return False
+        if passwords.needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
 
     def get_token(self, expires_in=3600):
-        now = datetime.utcnow()
-        if self.token and self.token_expiration > now + timedelta(seconds=60):
-            return self.token
-        self.token = base64.b64encode(os.urandom(24)).decode('utf-8')
-        self.token_expiration = now + timedelta(seconds=expires_in)
+        '''
+        issues a new api token and replaces the current one. only a sha256 of the
+        token is stored, so an issued token can't be handed out again.
+
+        :returns:           str -> the token, to be sent to the client
+        '''
+        if self.token:
+            _after_commit(token_cache.delete, self.token)
+        token = base64.b64encode(os.urandom(24)).decode('utf-8')
+        self.token = User.hash_token(token)
+        self.token_expiration = datetime.utcnow() + timedelta(seconds=expires_in)
         db.session.add(self)
-        return self.token
+        return token
 
     def revoke_token(self):
         self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+        if self.token:
+            _after_commit(token_cache.delete, self.token)
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        ''' drops the cached token lookups of deleted users once the delete commits '''
+        tokens = [obj.token for obj in session.deleted if isinstance(obj, cls) and obj.token]
+        if tokens:
+            _after_commit(token_cache.delete, *tokens, session=session)
 
     @staticmethod
-    def check_token(token):
-        user = User.query.filter_by(token=token).first()
-        if user is None or user.token_expiration < datetime.utcnow():
+    def hash_token(token):
+        return sha256(token.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def check_token_id(token):
+        '''
+        looks a token up without loading its user. hashes map to (user id, expiration)
+        in token_cache, so repeated calls with the same token skip the database.
+        unknown tokens aren't cached, so random bearer strings can't fill redis.
+
+        :returns:           int -> id of the token's user, or None if the token is
+                            unknown or expired
+        '''
+        key = User.hash_token(token)
+        entry = token_cache.get(key)
+        if entry is None:
+            row = (db.session.query(User.id, User.token_expiration)
+                             .filter(User.token == key)
+                             .first())
+            if row is None:
+                return None
+            entry = tuple(row)
+            token_cache.set(key, entry)
+        user_id, expiration = entry
+        if expiration < datetime.utcnow():
             return None
-        return user
+        return user_id
 
-    def to_dict(self, include_email=False):
+    @staticmethod
+    def check_token(token):
+        user_id = User.check_token_id(token)
+        return User.query.get(user_id) if user_id is not None else None
+
+    @staticmethod
+    def aggregate_counts(ids):
+        '''
+        counts posts, followers and followed users for a batch of users in a single
+        round-trip: three grouped counts combined with UNION ALL.
+
+        :param ids:         list of user ids
+        :returns:           dict -> {user_id: {'post_count': int, 'follower_count': int,
+                            'followed_count': int}} with an entry for every id
+        '''
+        counts = {id: {'post_count': 0, 'follower_count': 0, 'followed_count': 0}
+                  for id in ids}
+        if not ids:
+            return counts
+        posts = (db.select([db.literal('post_count'), Post.user_id, db.func.count()])
+                   .where(Post.user_id.in_(ids))
+                   .group_by(Post.user_id))
+        follower = (db.select([db.literal('follower_count'), followers.c.followed_id,
+                               db.func.count()])
+                      .where(followers.c.followed_id.in_(ids))
+                      .group_by(followers.c.followed_id))
+        followed = (db.select([db.literal('followed_count'), followers.c.follower_id,
+                               db.func.count()])
+                      .where(followers.c.follower_id.in_(ids))
+                      .group_by(followers.c.follower_id))
+        for name, id, count in db.session.execute(db.union_all(posts, follower, followed)):
+            counts[id][name] = count
+        return counts
+
+    @classmethod
+    def to_dicts(cls, items):
+        counts = cls.aggregate_counts([item.id for item in items])
+        return [item.to_dict(counts=counts[item.id]) for item in items]
+
+    def to_dict(self, include_email=False, counts=None):
+        if counts is None:
+            counts = User.aggregate_counts([self.id])[self.id]
         data = {
             'id': self.id,
             'username': self.username,
             'last_seen': self.last_seen.isoformat() + 'Z',
             'about_me': self.about_me,
-            'post_count': self.posts.count(),
-            'follower_count': self.followers.count(),
-            'followed_count': self.followed.count(),
+            'post_count': counts['post_count'],
+            'follower_count': counts['follower_count'],
+            'followed_count': counts['followed_count'],
             '_links': {
                 'self': url_for('api.get_user', id=self.id),
                 'followers': url_for('api.get_followers', id=self.id),
@@ -148,21 +309,84 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             if new_user and 'password' in data:
                 self.set_password(data['password'])
 
+    def get_last_seen(self):
+        ''' last_seen including the value still buffered in redis '''
+        return last_seen.get(self)
+
+    @staticmethod
+    def flush_last_seen():
+        '''
+        writes the buffered last seen times to the users table in one bulk UPDATE.
+        the buffer is only cleared after the commit, so a failed flush is retried.
+
+        :returns:           int -> number of users updated
+        '''
+        buffered = last_seen.pending()
+        if buffered:
+            seen = {id: datetime.utcfromtimestamp(float(ts)) for id, ts in buffered.items()}
+            db.session.execute(
+                User.__table__.update()
+                .where(User.id.in_(seen))
+                .values(last_seen=db.case(seen, value=User.id))
+            )
+            db.session.commit()
+            last_seen.clear(buffered)
+        return len(buffered)
+
+    @db.validates('email')
+    def _set_email(self, key, email):
+        self.avatar_hash = gravatar_hash(email) if email is not None else None
+        return email
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        return f'https://www.gravatar.com/avatar/{self.avatar_hash}?d=identicon&s={size}'
+
+    @staticmethod
+    def avatar_urls(users, size):
+        '''
+        the avatar urls of a page of users at once, for the templates listing posts.
+
+        :param users:       iterable of users (e.g. - the authors of the posts on a page)
+        :param size:        image size in pixels
+        :returns:           dict -> {user.id: url}
+        '''
+        url = 'https://www.gravatar.com/avatar/{}?d=identicon&s=' + str(size)
+        return {user.id: url.format(user.avatar_hash) for user in users}
 
     def follow(self, user):
-        if not self.is_following(user):
+        if not self._follows(user):
             self.followed.append(user)
+            _after_commit(timeline.backfill, self.id, user.recent_post_entries())
+            _after_commit(follow_graph.add, self.id, user.id)
 
     def unfollow(self, user):
-        if self.is_following(user):
+        if self._follows(user):
             self.followed.remove(user)
+            _after_commit(timeline.prune, self.id, [id for id, _ in user.recent_post_entries()])
+            _after_commit(follow_graph.remove, self.id, user.id)
+
+    def _follows(self, user):
+        # asks the database, which also sees the follows of this transaction that
+        # the follow graph cache only gets on commit
+        return db.session.query(db.exists().where(db.and_(
+            followers.c.follower_id == self.id, followers.c.followed_id == user.id,
+        ))).scalar()
 
     def is_following(self, user):
-        return self.followed.filter(
-            followers.c.followed_id == user.id).count() > 0
+        '''
+        answered by the follow graph cache (app.follow_graph) without sql. a cold cache
+        is loaded with the user's followed ids first, one scan of the followers primary
+        key; without redis the database is asked directly.
+        '''
+        following, version = follow_graph.following_among(self.id, [user.id])
+        if following is not None:
+            return user.id in following
+        if version is None:
+            return self._follows(user)
+        followed = [id for id, in db.session.query(followers.c.followed_id)
+                                            .filter(followers.c.follower_id == self.id)]
+        follow_graph.load(self.id, version, followed)
+        return user.id in followed
 
     def followed_posts(self):
         followed = (Post.query
@@ -171,6 +395,46 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         own = Post.query.filter_by(user_id=self.id)
         return followed.union(own).order_by(Post.timestamp.desc())
 
+    def timeline_posts(self, cursor, per_page):
+        '''
+        reads a page of the home timeline from the materialized timeline in redis.
+
+        :param cursor:      keyset cursor from a previous page or None for the first page
+        :param per_page:    number of posts per page
+        :returns:           KeysetPagination or None when the timeline is cold and
+                            followed_posts should be used instead
+        '''
+        columns = [Post.timestamp, Post.id]
+        decoded = decode_cursor(cursor, columns) if cursor else None
+        direction, key = decoded if decoded else ('next', None)
+        result = timeline.get_page(self.id, key, direction, per_page)
+        if result is None:
+            return None
+        ids, has_more = result
+        posts = []
+        if ids:
+            when = [(id, i) for i, id in enumerate(ids)]
+            posts = (Post.with_authors(Post.query.filter(Post.id.in_(ids)))
+                         .order_by(db.case(when, value=Post.id))
+                         .all())
+        return KeysetPagination(posts, columns, direction, has_more, decoded is not None)
+
+    def rebuild_timeline(self):
+        ''' warms the materialized home timeline from the followed_posts query '''
+        timeline.start_rebuild(self.id)
+        entries = (self.followed_posts()
+                       .with_entities(Post.id, Post.timestamp)
+                       .limit(current_app.config['TIMELINE_LENGTH'])
+                       .all())
+        timeline.rebuild(self.id, entries)
+
+    def recent_post_entries(self):
+        ''' (id, timestamp) of the posts that can appear in a follower's timeline '''
+        return (self.posts.with_entities(Post.id, Post.timestamp)
+                          .order_by(Post.timestamp.desc())
+                          .limit(current_app.config['TIMELINE_LENGTH'])
+                          .all())
+
     def get_reset_password_token(self, expires_in=600):
         return (jwt.encode({'reset_password': self.id, 'exp': time() + expires_in},
                            current_app.config['SECRET_KEY'],
@@ -178,26 +442,88 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
                    .decode('utf-8'))
 
     def new_messages(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return (Message.query.filter_by(recipient=self)
-                             .filter(Message.timestamp > last_read_time)
-                             .count())
+        return self.unread_message_count or 0
+
+    def add_unread_message(self):
+        '''
+        increments the unread counter with an atomic UPDATE ... SET n = n + 1, so
+        concurrent senders don't lose counts.
+
+        :returns:           int -> the new count
+        '''
+        self.unread_message_count = db.func.coalesce(User.unread_message_count, 0) + 1
+        db.session.flush()
+        return self.unread_message_count
+
+    def read_messages(self):
+        ''' marks every received message read and resets the unread counter '''
+        self.last_message_read_time = datetime.utcnow()
+        self.unread_message_count = 0
+
+    @staticmethod
+    def reconcile_unread_counts():
+        '''
+        recounts the unread messages of every user in one correlated UPDATE and fixes
+        the counters that drifted, e.g. from a message that raced read_messages.
+        each count is a range scan of the (recipient_id, timestamp) index.
+
+        :returns:           int -> number of users whose counter was corrected
+        '''
+        last_read_time = db.func.coalesce(User.last_message_read_time, datetime(1900, 1, 1))
+        count = (db.select([db.func.count(Message.id)])
+                   .where(Message.recipient_id == User.id)
+                   .where(Message.timestamp > last_read_time)
+                   .as_scalar())
+        result = db.session.execute(
+            User.__table__.update()
+                          .where(db.func.coalesce(User.unread_message_count, -1) != count)
+                          .values(unread_message_count=count)
+        )
+        db.session.commit()
+        return result.rowcount
 
     def add_notification(self, name, data):
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
+        '''
+        replaces the user's notification of the given name with a single upsert. once
+        the transaction commits it is also stored in the user's latest-state hash and
+        published to the user's open notification streams. notifications carry unread
+        counts and task progress, so the user's cached chrome is dropped as well.
+        '''
+        timestamp = time()
+        Notification.upsert(self.id, name, json.dumps(data), timestamp)
+        _after_commit(push.publish, self.id, name, data, timestamp)
+        _after_commit(chrome.invalidate, self.id)
 
     def launch_task(self, name, description, *args, **kwargs):
-        rq_job = current_app.task_queue.enqueue('app.tasks.' + name, self.id, *args, **kwargs)
+        priority = current_app.config['TASK_PRIORITIES'].get(name, 'default')
+        rq_job = current_app.task_queues[priority].enqueue(
+            'app.tasks.' + name, self.id, *args, **kwargs)
         task = Task(id=rq_job.get_id(), name=name, description=description, user=self)
         db.session.add(task)
+        _after_commit(chrome.invalidate, self.id)
         return task
 
     def get_tasks_in_progress(self):
         return Task.query.filter_by(user=self, complete=False).all()
 
+    def chrome_state(self):
+        '''
+        unread message count and tasks in progress for the chrome of base.pug (see
+        app.chrome): the count is a column of the user, the tasks one sql query, and
+        their progress one redis round-trip.
+
+        :returns:           dict -> {'new_messages': int,
+                                     'tasks': lst({'id', 'description', 'progress'})}
+        '''
+        tasks = self.get_tasks_in_progress()
+        return {
+            'new_messages': self.new_messages(),
+            'tasks': [
+                {'id': task.id, 'description': task.description, 'progress': progress}
+                for task, progress in zip(tasks, Task.get_progress_many(tasks))
+            ],
+        }
+
     def get_task_in_progress(self, name):
         return Task.query.filter_by(name=name, user=self, complete=False).first()
 
@@ -229,74 +555,185 @@ class SearchableMixin(object):
         :param page:        refers to page number. used for returning the correct results based
                             on pagination
         :param per_page:    results per page to allow calculation for proper pagination results
-        :returns:           tuple -> (lst(Post.id), int(num_results))
-                            if no results found, will return empty db object and 0,
-                            otherwise, will return a list of ids and the number of results
+        :returns:           tuple -> (lst(model), int(num_results))
+                            if no results found, will return an empty list and 0, otherwise,
+                            will return the page of model objects and the number of results
         '''
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        ids, total = cached_query_index(cls.__tablename__, expression, page, per_page)
         if total == 0:
-            return cls.query.filter_by(id=0), 0
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id)), total
+            return [], 0
+        return cls.get_cached(ids), total
 
     @classmethod
-    def before_commit(cls, session):
+    def get_cached(cls, ids):
         '''
-        class method: sqlalchemy event will trigger this before all session commits. method will
-        identify objects in the session that need to be indexed in elastic search and copy them
-        into the _changes property on the session which allows for easy reaccess following commit.
+        class method: loads model objects by id through the search row cache. cached rows
+        are attached to the session without a query; only the misses are selected from
+        the database, and their column values are cached for the next search.
 
-        :param cls:         'class' -> refers to the model invoking this method (e.g. - Post)
-        :param session:     the database session object
+        :param cls:         'class' -> refers to the model invoking this method. (e.g. - Post)
+        :param ids:         ids in the order the objects should be returned
+        :returns:           lst(model) -> objects that still exist, in the order of ids
+        '''
+        keys = {id: f'{cls.__tablename__}:{id}' for id in ids}
+        cached = row_cache.get_many(list(keys.values()))
+        objects = {}
+        for id, key in keys.items():
+            if cached[key] is not None:
+                obj = cls(**cached[key])
+                db.make_transient_to_detached(obj)
+                objects[id] = db.session.merge(obj, load=False)
+
+        missing = [id for id in ids if id not in objects]
+        if missing:
+            columns = [column.key for column in cls.__table__.columns]
+            rows = {}
+            for obj in cls.query.filter(cls.id.in_(missing)):
+                objects[obj.id] = obj
+                rows[keys[obj.id]] = {column: getattr(obj, column) for column in columns}
+            row_cache.set_many(rows)
+        return [objects[id] for id in ids if id in objects]
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        '''
+        class method: sqlalchemy event will trigger this after every flush, while ids are
+        assigned and attribute history is still available. builds elastic bulk actions for
+        searchable objects that were added, deleted, or updated in a __searchable__ field,
+        and holds them on the session until the transaction commits.
+
+        :param cls:             'class' -> SearchableMixin
+        :param session:         the database session object
+        :param flush_context:   unused, passed by sqlalchemy
         :returns:
         '''
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted),
-        }
+        actions = session.info.setdefault('search_actions', [])
+        for obj in session.new:
+            if isinstance(obj, SearchableMixin):
+                actions.append(index_action(obj.__tablename__, obj))
+        for obj in session.dirty:
+            if isinstance(obj, SearchableMixin) and obj.searchable_changed():
+                actions.append(index_action(obj.__tablename__, obj))
+        for obj in session.deleted:
+            if isinstance(obj, SearchableMixin):
+                actions.append(delete_action(obj.__tablename__, obj))
+        stale = [f'{obj.__tablename__}:{obj.id}' for obj in session.dirty | session.deleted
+                 if isinstance(obj, SearchableMixin)]
+        if stale:
+            _after_commit(row_cache.delete, *stale, session=session)
 
     @classmethod
     def after_commit(cls, session):
         '''
-        class method: wraps the add_to_index method from app.search. sqlalchemy event will trigger
-        this after all session commits. method will loop over all session objects and add them
-        to an index in elastic search before resetting the session._changes property.
+        class method: wraps the enqueue_bulk method from app.search. sqlalchemy event will
+        trigger this after all session commits. sends every action collected during the
+        transaction to elastic as one _bulk request, run by the task queue.
 
-        :param cls:         'class' -> refers to the model invoking this method. (e.g. - Post)
+        :param cls:         'class' -> SearchableMixin
         :param session:     the database session object
         :returns:
         '''
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+        actions = session.info.pop('search_actions', None)
+        if actions:
+            enqueue_bulk(actions)
+
+    @classmethod
+    def after_rollback(cls, session, previous_transaction):
+        ''' drops the actions of a transaction that was rolled back '''
+        session.info.pop('search_actions', None)
+
+    def searchable_changed(self):
+        ''' whether a pending update touches any of the __searchable__ fields '''
+        state = db.inspect(self)
+        return any(state.attrs[field].history.has_changes() for field in self.__searchable__)
 
     @classmethod
-    def reindex(cls):
+    def reindex(cls, batch_size=None, workers=None, resume=False, new_index=False,
+                progress=None):
         '''
-        class method: wraps the add_to_index method from app.search. will reindex any
-        model fields marked for indexing in the sqlalchemy models. provides a way to
-        reset the elastic search indexes.
+        class method: rebuilds the elastic index of the model. rows are streamed in id
+        order, one keyset chunk at a time and without loading model objects, and every
+        chunk is sent as one _bulk request by a pool of worker threads. the last id known
+        to be indexed is checkpointed in redis so an interrupted run can resume.
+
+        with new_index the rows go into a fresh index and the alias the app queries is
+        swapped over at the end, so searches keep working during the rebuild. changes
+        committed meanwhile go to the old index; reindexing again without new_index
+        catches them up.
 
         :param cls:         'class' -> refers to the model invoking this method. (e.g. - Post)
-        :returns:
+        :param batch_size:  rows per chunk and _bulk request (SEARCH_REINDEX_BATCH_SIZE)
+        :param workers:     concurrent _bulk requests (SEARCH_REINDEX_WORKERS)
+        :param resume:      continue from the last checkpoint instead of the first row
+        :param new_index:   build into a fresh index and swap the alias when done
+        :param progress:    optional callable(indexed, total) called after every chunk
+        :returns:           int -> number of rows indexed
         '''
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+        backend = get_backend()
+        if not backend.external:
+            # in-database indexes are maintained by the database itself
+            backend.rebuild(cls.__tablename__)
+            return cls.query.count()
+
+        app = current_app._get_current_object()
+        batch_size = batch_size or app.config['SEARCH_REINDEX_BATCH_SIZE']
+        workers = workers or app.config['SEARCH_REINDEX_WORKERS']
+        alias = cls.__tablename__
+        checkpoint_key = f'search:reindex:{alias}'
+
+        checkpoint = json.loads(app.redis.get(checkpoint_key) or '{}') if resume else {}
+        target = checkpoint.get('index') or (create_index(alias) if new_index else alias)
+        last_id = checkpoint.get('last_id', 0)
+        columns = [getattr(cls, field) for field in cls.__searchable__]
+        total = cls.query.filter(cls.id > last_id).count()
+
+        def send(actions):
+            with app.app_context():
+                failed = bulk(actions)
+                if failed:
+                    dead_letter(failed, 'rejected during reindex')
+
+        indexed = 0
+        pending = deque()
+
+        def complete_oldest():
+            # chunks complete in submission order, so the checkpoint never skips rows
+            nonlocal indexed
+            future, done_id, count = pending.popleft()
+            future.result()
+            indexed += count
+            app.redis.set(checkpoint_key, json.dumps({'index': target, 'last_id': done_id}))
+            if progress:
+                progress(indexed, total)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                rows = (db.session.query(cls.id, *columns)
+                                  .filter(cls.id > last_id)
+                                  .order_by(cls.id)
+                                  .limit(batch_size)
+                                  .yield_per(batch_size))
+                actions = [index_action(target, row, cls.__searchable__) for row in rows]
+                if not actions:
+                    break
+                last_id = actions[-1]['id']
+                pending.append((pool.submit(send, actions), last_id, len(actions)))
+                while pending and (len(pending) >= workers * 2 or pending[0][0].done()):
+                    complete_oldest()
+            while pending:
+                complete_oldest()
+
+        if target != alias:
+            swap_alias(alias, target)
+        app.redis.delete(checkpoint_key)
+        return indexed
 
 
 class Post(SearchableMixin, db.Model):
     __tablename__ = 'posts'
     __searchable__ = ['body']
+    # a user's posts, newest first: the profile page and each followed user in followed_posts
+    __table_args__ = (db.Index('ix_posts_user_id_timestamp', 'user_id', 'timestamp'),)
 
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
@@ -312,9 +749,106 @@ class Post(SearchableMixin, db.Model):
     def __repr__(self):
         return f'<Post {self.body}>'
 
+    @staticmethod
+    def with_authors(query):
+        '''
+        joins the author of every post into the page's select, so rendering the page
+        doesn't lazy load one user per post.
+
+        :param query:       query of posts (e.g. - Post.query, user.followed_posts())
+        :returns:           the query, loading Post.author eagerly
+        '''
+        return query.options(db.joinedload(Post.author))
+
+    @staticmethod
+    def load_authors(posts):
+        '''
+        counterpart of with_authors for posts that were not loaded by a query of
+        their own (e.g. - search results rebuilt from the row cache): selects the
+        authors that aren't loaded yet in one round-trip and attaches them.
+
+        :param posts:       list of posts
+        :returns:           the same list
+        '''
+        pending = [post for post in posts if 'author' not in db.inspect(post).dict]
+        if pending:
+            ids = {post.user_id for post in pending}
+            authors = {user.id: user for user in User.query.filter(User.id.in_(ids))}
+            for post in pending:
+                set_committed_value(post, 'author', authors.get(post.user_id))
+        return posts
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        '''
+        class method: sqlalchemy event will trigger this after every flush, while new posts
+        have their ids but the transaction is still open. looks up the followers of each new
+        or deleted post's author and queues the timeline fan-out until the commit succeeds.
+        new posts whose language wasn't guessed locally are queued for remote detection.
+
+        :param cls:             'class' -> Post
+        :param session:         the database session object
+        :param flush_context:   unused, passed by sqlalchemy
+        :returns:
+        '''
+        inline = current_app.config['TIMELINE_FANOUT_INLINE']
+        for obj in session.new:
+            if isinstance(obj, cls):
+                # one row past the limit tells whether the author has more followers
+                ids = cls.audience(obj.user_id, limit=inline + 1)
+                if len(ids) > inline + 1:
+                    _after_commit(timeline.queue_fan_out, obj.id, obj.user_id, obj.timestamp,
+                                  session=session)
+                else:
+                    _after_commit(timeline.add_post, obj.id, obj.timestamp, ids,
+                                  session=session)
+                if obj.language is None:
+                    _after_commit(queue_detection, obj.id, session=session)
+        for obj in session.deleted:
+            if isinstance(obj, cls):
+                ids = cls.audience(obj.user_id, limit=inline + 1)
+                if len(ids) > inline + 1:
+                    _after_commit(timeline.queue_fan_out, obj.id, obj.user_id, session=session)
+                else:
+                    _after_commit(timeline.remove_post, obj.id, ids, session=session)
+
+    @staticmethod
+    def audience(user_id, limit=None):
+        '''
+        ids of the users whose home timeline shows the posts of a user: the author
+        and their followers.
+
+        :param user_id:     id of the author
+        :param limit:       optional maximum number of followers to read
+        :returns:           list -> the author's id, then the followers'
+        '''
+        ids = db.session.query(followers.c.follower_id) \
+                        .filter(followers.c.followed_id == user_id) \
+                        .limit(limit)
+        return [user_id] + [id for id, in ids]
+
+
+def _after_commit(op, *args, session=db.session):
+    '''
+    holds a redis side effect (timeline or cache write) on the session until the
+    transaction commits, so a rollback never leaves redis ahead of the database.
+    '''
+    session.info.setdefault('after_commit_ops', []).append((op, args))
+
+
+def _run_after_commit_ops(session):
+    for op, args in session.info.pop('after_commit_ops', []):
+        op(*args)
+
+
+def _discard_after_commit_ops(session, previous_transaction):
+    session.info.pop('after_commit_ops', None)
+
 
 class Message(db.Model):
     __tablename__ = 'messages'
+    # serves the inbox (newest first per recipient) and the unread recount
+    __table_args__ = (db.Index('ix_messages_recipient_id_timestamp', 'recipient_id', 'timestamp'),)
 
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('users.id'))
@@ -328,6 +862,8 @@ class Message(db.Model):
 
 class Notification(db.Model):
     __tablename__ = 'notifications'
+    # a user has at most one notification of each name, see upsert
+    __table_args__ = (db.Index('ix_notifications_user_id_name', 'user_id', 'name', unique=True),)
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), index=True)
@@ -338,6 +874,41 @@ class Notification(db.Model):
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    def to_dict(self):
+        return {'name': self.name, 'data': self.get_data(), 'timestamp': self.timestamp}
+
+    @staticmethod
+    def upsert(user_id, name, payload_json, timestamp):
+        '''
+        inserts a notification, or updates the user's existing one of the same name,
+        in one statement. ON CONFLICT ... DO UPDATE is understood by both postgres
+        and sqlite (3.24+).
+        '''
+        db.session.execute(
+            'INSERT INTO notifications (user_id, name, payload_json, timestamp) '
+            'VALUES (:user_id, :name, :payload_json, :timestamp) '
+            'ON CONFLICT (user_id, name) DO UPDATE SET '
+            'payload_json = excluded.payload_json, timestamp = excluded.timestamp',
+            {'user_id': user_id, 'name': name, 'payload_json': payload_json,
+             'timestamp': timestamp},
+        )
+
+    @staticmethod
+    def sweep(before):
+        '''
+        deletes the notifications last updated before a point in time and drops the
+        latest-state hashes of their users, which are refilled on the next read.
+
+        :param before:      epoch seconds
+        :returns:           int -> number of notifications deleted
+        '''
+        stale = Notification.query.filter(Notification.timestamp < before)
+        user_ids = [id for id, in stale.with_entities(Notification.user_id).distinct()]
+        count = stale.delete(synchronize_session=False)
+        db.session.commit()
+        push.forget(*user_ids)
+        return count
+
 
 class Task(db.Model):
     __tablename__ = 'tasks'
@@ -357,6 +928,19 @@ class Task(db.Model):
             return None
         return rq_job
 
+    def get_export_path(self):
+        ''' file the export_posts task writes, see app.tasks.export_posts '''
+        return Task.export_path(self.user_id, self.id)
+
+    @staticmethod
+    def export_path(user_id, task_id):
+        '''
+        :param user_id:     id of the exporting user
+        :param task_id:     id of the export task, the same as its rq job's
+        :returns:           str -> path of the export under EXPORT_DIR
+        '''
+        return os.path.join(current_app.config['EXPORT_DIR'], str(user_id), f'{task_id}.ndjson.gz')
+
     def get_progress(self):
         '''
         if job id from model does not exist in rq, job has finished and will
@@ -369,6 +953,39 @@ class Task(db.Model):
         job = self.get_rq_job()
         return job.meta.get('progress', 0) if job is not None else 100
 
+    @staticmethod
+    def get_progress_many(tasks):
+        '''
+        get_progress for several tasks in one pipelined redis round-trip, reading the
+        status and meta fields of the rq job hashes directly instead of Job.fetch.
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+        :param tasks:       list of Task
+        :returns:           list -> progress of each task, in order
+        '''
+        if not tasks:
+            return []
+        pipe = current_app.redis.pipeline(transaction=False)
+        for task in tasks:
+            pipe.hmget(rq.job.Job.key_for(task.id), 'status', 'meta')
+        try:
+            jobs = pipe.execute()
+        except redis.exceptions.RedisError:
+            return [100] * len(tasks)
+        progress = []
+        for status, meta in jobs:
+            if status is None:
+                progress.append(100)
+            else:
+                meta = DefaultSerializer.loads(meta) if meta else {}
+                progress.append(meta.get('progress', 0))
+        return progress
+
+
+register_fulltext(Post)
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_soft_rollback', SearchableMixin.after_rollback)
+db.event.listen(db.session, 'after_flush', Post.after_flush)
+db.event.listen(db.session, 'after_flush', User.after_flush)
+db.event.listen(db.session, 'after_commit', _run_after_commit_ops)
+db.event.listen(db.session, 'after_soft_rollback', _discard_after_commit_ops)
@@ -0,0 +1,118 @@
+import base64
+from datetime import datetime
+import json
+from app import db
+
+
+def encode_cursor(values, direction):
+    '''
+    builds an opaque, url safe cursor from the sort key of a row.
+
+    :param values:      sort key values of the boundary row (e.g. - (timestamp, id))
+    :param direction:   'next' for older/later rows, 'prev' for newer/earlier rows
+    :returns:           str -> base64 encoded json cursor
+    '''
+    key = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps({'d': direction, 'k': key}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    '''
+    reverses encode_cursor. datetime columns are parsed back from their iso format.
+
+    :param cursor:      cursor string from the query string
+    :param columns:     sort key columns the cursor was built from
+    :returns:           tuple -> (str(direction), lst(values)) or None if the cursor
+                        is malformed or doesn't match the columns
+    '''
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json.loads(raw.decode('utf-8'))
+        direction, key = data['d'], data['k']
+        if direction not in ('next', 'prev') or len(key) != len(columns):
+            return None
+        values = []
+        for column, value in zip(columns, key):
+            if isinstance(column.type, db.DateTime):
+                value = datetime.fromisoformat(value)
+            values.append(value)
+    except (ValueError, TypeError, KeyError):
+        return None
+    return direction, values
+
+
+def row_key(row, columns):
+    return [getattr(row, column.key) for column in columns]
+
+
+def keyset_filter(columns, values, direction, descending=True):
+    '''
+    builds the where clause that selects the rows after (or before) the cursor row.
+    the row comparison (a, b) < (x, y) is expanded to a < x OR (a = x AND b < y)
+    so it works the same on sqlite and postgres.
+    '''
+    smaller = (direction == 'next') == descending
+    clause = None
+    for column, value in reversed(list(zip(columns, values))):
+        beyond = column < value if smaller else column > value
+        clause = beyond if clause is None else db.or_(beyond, db.and_(column == value, clause))
+    return clause
+
+
+class KeysetPagination(object):
+    '''
+    one page of a keyset (cursor) paginated listing. exposes the same has_next and
+    has_prev flags as the flask-sqlalchemy Pagination object, but never counts the
+    full result set; cursors point at the boundary rows of the page instead.
+    '''
+    def __init__(self, items, columns, direction, has_more, has_cursor):
+        self.items = items
+        self.columns = columns
+        if direction == 'prev':
+            self.has_next, self.has_prev = has_cursor, has_more
+        else:
+            self.has_next, self.has_prev = has_more, has_cursor
+
+    @property
+    def next_cursor(self):
+        if not self.has_next or not self.items:
+            return None
+        return encode_cursor(row_key(self.items[-1], self.columns), 'next')
+
+    @property
+    def prev_cursor(self):
+        if not self.has_prev or not self.items:
+            return None
+        return encode_cursor(row_key(self.items[0], self.columns), 'prev')
+
+
+def paginate_keyset(query, columns, cursor, per_page, descending=True):
+    '''
+    keyset counterpart of query.paginate(). seeks straight to the cursor row through
+    the index on the sort columns instead of scanning OFFSET rows, and fetches one
+    extra row to tell whether there is a further page.
+
+    :param query:       sqlalchemy query to paginate. any existing ordering is replaced
+    :param columns:     unique sort key, most significant first (e.g. - [Post.timestamp, Post.id])
+    :param cursor:      cursor from a previous page or None for the first page.
+                        malformed cursors are treated as the first page
+    :param per_page:    results per page
+    :param descending:  True for newest first listings
+    :returns:           KeysetPagination
+    '''
+    decoded = decode_cursor(cursor, columns) if cursor else None
+    direction = decoded[0] if decoded else 'next'
+    if decoded:
+        query = query.filter(keyset_filter(columns, decoded[1], direction, descending))
+    # a 'prev' page is read in reverse order from the cursor and flipped back below
+    ascending = (direction == 'prev') == descending
+    query = query.order_by(None).order_by(
+        *[column.asc() if ascending else column.desc() for column in columns]
+    )
+    items = query.limit(per_page + 1).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if direction == 'prev':
+        items.reverse()
+    return KeysetPagination(items, columns, direction, has_more, decoded is not None)
@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from flask import current_app, has_app_context
+import os
+import threading
+from werkzeug.security import (
+    DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+)
+
+
+class PasswordHashBusy(Exception):
+    ''' every hashing slot stayed taken for PASSWORD_HASH_TIMEOUT seconds '''
+
+
+# hashing runs on a pool of PASSWORD_HASH_WORKERS threads (the cpu count by default)
+# and callers have to get one of as many slots first, so a flood of login attempts
+# waits for the pool instead of putting a hash on every request thread
+_executor = None
+_slots = None
+_lock = threading.Lock()
+
+
+def _config():
+    # outside an app (scripts, model unit tests) the defaults of Config apply
+    return current_app.config if has_app_context() else vars(Config)
+
+
+def _pool():
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            workers = _config()['PASSWORD_HASH_WORKERS'] or os.cpu_count()
+            _executor = ThreadPoolExecutor(workers, thread_name_prefix='password-hash')
+            _slots = threading.BoundedSemaphore(workers)
+    return _executor, _slots
+
+
+def _run(fn, *args):
+    executor, slots = _pool()
+    if not slots.acquire(timeout=_config()['PASSWORD_HASH_TIMEOUT']):
+        raise PasswordHashBusy()
+    try:
+        return executor.submit(fn, *args).result()
+    finally:
+        slots.release()
+
+
+def _normalize(method):
+    ''' werkzeug stores pbkdf2 hashes with the iteration count, even when it's implied '''
+    if method.startswith('pbkdf2:') and method.count(':') == 1:
+        return f'{method}:{DEFAULT_PBKDF2_ITERATIONS}'
+    return method
+
+
+def hash_password(password):
+    '''
+    hashes a password with PASSWORD_HASH_METHOD (e.g. - 'pbkdf2:sha256:150000')
+    and a salt of PASSWORD_SALT_LENGTH characters.
+    '''
+    return _run(
+        generate_password_hash, password,
+        _config()['PASSWORD_HASH_METHOD'],
+        _config()['PASSWORD_SALT_LENGTH'],
+    )
+
+
+def check_password(pwhash, password):
+    return _run(check_password_hash, pwhash, password)
+
+
+def needs_rehash(pwhash):
+    ''' whether a stored hash was made with other parameters than the configured ones '''
+    method, salt, _ = pwhash.split('$', 2)
+    return _normalize(method) != _normalize(_config()['PASSWORD_HASH_METHOD']) or \
+        len(salt) != _config()['PASSWORD_SALT_LENGTH']
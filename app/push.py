@@ -0,0 +1,124 @@
+from flask import current_app
+import json
+import redis
+import time
+
+
+# field present in a latest-state hash once it holds every notification of the user
+_COMPLETE = ''
+
+
+def channel(user_id):
+    ''' redis pub/sub channel carrying the notifications of one user '''
+    return f'notifications:{user_id}'
+
+
+def latest_key(user_id):
+    ''' redis hash of notification name -> latest notification of one user '''
+    return f'notifications:latest:{user_id}'
+
+
+def publish(user_id, name, data, timestamp):
+    '''
+    records a committed notification in the user's latest-state hash and pushes it
+    to the clients streaming it (see stream). a client that misses it, e.g. while
+    reconnecting, catches up from the hash (see latest).
+    '''
+    message = json.dumps({'name': name, 'data': data, 'timestamp': timestamp})
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        pipe.hset(latest_key(user_id), name, message)
+        pipe.expire(latest_key(user_id), current_app.config['NOTIFICATION_CACHE_TTL'])
+        pipe.publish(channel(user_id), message)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('could not publish notification %s of user %s', name, user_id)
+
+
+def latest(user_id):
+    '''
+    the latest notification of every name for a user, from redis.
+
+    :returns:           list -> notification dicts, or None when the hash isn't
+                        complete (never filled, expired, or redis is unavailable)
+    '''
+    try:
+        fields = current_app.redis.hgetall(latest_key(user_id))
+    except redis.exceptions.RedisError:
+        return None
+    if _COMPLETE.encode() not in fields:
+        return None
+    return [json.loads(value) for name, value in fields.items() if name != _COMPLETE.encode()]
+
+
+def fill(user_id, notifications):
+    '''
+    completes the latest-state hash of a user from the database. fields use HSETNX,
+    so a notification published while the rows were being read is not overwritten
+    with the older value.
+
+    :param notifications:   every notification dict of the user
+    '''
+    key = latest_key(user_id)
+    try:
+        pipe = current_app.redis.pipeline()
+        for notification in notifications:
+            pipe.hsetnx(key, notification['name'], json.dumps(notification))
+        pipe.hset(key, _COMPLETE, '')
+        pipe.expire(key, current_app.config['NOTIFICATION_CACHE_TTL'])
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        pass
+
+
+def forget(*user_ids):
+    ''' drops latest-state hashes, e.g. after their rows were swept '''
+    if not user_ids:
+        return
+    try:
+        current_app.redis.delete(*[latest_key(user_id) for user_id in user_ids])
+    except redis.exceptions.RedisError:
+        pass
+
+
+def subscribe(user_id):
+    '''
+    opens the subscription of a stream before the catch-up query runs, so nothing
+    published in between is lost. raises RedisError when redis is unavailable.
+    '''
+    pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(channel(user_id))
+    return pubsub
+
+
+def _event(notification):
+    return f"id: {notification['timestamp']}\ndata: {json.dumps(notification)}\n\n"
+
+
+def stream(pubsub, backlog, heartbeat, timeout):
+    '''
+    generates a text/event-stream: first the backlog, then every notification
+    published on the subscription. a comment line goes out every heartbeat seconds
+    so proxies keep the connection open, and the stream ends after timeout seconds;
+    EventSource reconnects by itself, passing the id of the last event it got.
+
+    :param pubsub:      subscription returned by subscribe
+    :param backlog:     list of notification dicts the client hasn't seen yet
+    :param heartbeat:   seconds between keep-alive comments
+    :param timeout:     seconds before the stream is closed
+    :returns:           generator -> str(event)
+    '''
+    try:
+        for notification in backlog:
+            yield _event(notification)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            message = pubsub.get_message(timeout=heartbeat)
+            if message is None:
+                yield ': keep-alive\n\n'
+            elif message['type'] == 'message':
+                yield _event(json.loads(message['data']))
+    except redis.exceptions.RedisError:
+        pass
+    finally:
+        pubsub.close()
@@ -0,0 +1,131 @@
+from flask import current_app, request
+from flask_login import current_user
+import math
+import redis
+import threading
+import time
+from werkzeug.exceptions import TooManyRequests
+
+
+# token bucket: a client holds up to `capacity` requests and gets `rate` back per
+# second. read, refill and take happen in one script, so concurrent requests of a
+# client can't both take the last token. the time is redis' own, so app servers
+# with skewed clocks share one bucket correctly (before redis 5 that needs effects
+# replication to be turned on). returns {allowed, ms to wait}
+_TOKEN_BUCKET = '''
+if redis.replicate_commands then redis.replicate_commands() end
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed, wait = 0, 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return {allowed, math.ceil(wait * 1000)}
+'''
+
+_PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+_script = None
+_memory = {}
+_memory_lock = threading.Lock()
+_memory_pruned = 0
+
+
+def parse_limit(limit):
+    '''
+    :param limit:       '<count>/<second|minute|hour|day>' (e.g. - '10/minute')
+    :returns:           (capacity, tokens refilled per second)
+    '''
+    count, period = limit.split('/')
+    return int(count), int(count) / _PERIODS[period.strip().rstrip('s')]
+
+
+def _take_redis(key, capacity, rate):
+    global _script
+    if _script is None:
+        _script = current_app.redis.register_script(_TOKEN_BUCKET)
+    allowed, wait = _script(keys=[key], args=[capacity, rate], client=current_app.redis)
+    return bool(allowed), wait / 1000
+
+
+def _take_memory(key, capacity, rate):
+    # same bucket, per process. for tests and single process development servers.
+    # entries are (tokens, last update, time the bucket is full again); full buckets
+    # are the same as missing ones, so they're dropped at most once a second
+    global _memory_pruned
+    now = time.monotonic()
+    with _memory_lock:
+        if now - _memory_pruned >= 1:
+            for stale in [k for k, (_, _, full) in _memory.items() if full <= now]:
+                del _memory[stale]
+            _memory_pruned = now
+        tokens, ts, _ = _memory.get(key, (capacity, now, now))
+        tokens = min(capacity, tokens + (now - ts) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        _memory[key] = (tokens, now, now + (capacity - tokens) / rate)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+
+_backends = {'redis': _take_redis, 'memory': _take_memory}
+
+
+def _client():
+    # remote_addr is the client's own address when PROXY_COUNT matches the proxies
+    # in front of the app (see create_app), not the router's shared one
+    if current_user.is_authenticated:
+        return f'user:{current_user.id}'
+    return f'ip:{request.remote_addr}'
+
+
+def _rules():
+    '''
+    the RATELIMITS entries of this request: per endpoint and per blueprint, each
+    optionally for one method only (e.g. - 'POST auth.login'). the most specific
+    key of each level applies
+    '''
+    limits = current_app.config['RATELIMITS']
+    for name in (request.endpoint, request.blueprint):
+        if not name:
+            continue
+        for key in (f'{request.method} {name}', name):
+            if key in limits:
+                yield key, limits[key]
+                break
+
+
+def check():
+    '''
+    before_request hook: takes a token from every bucket of the request and aborts
+    with 429 and Retry-After when one is empty. lets requests through when redis
+    is down.
+    '''
+    take = _backends[current_app.config['RATELIMIT_BACKEND']]
+    retry_after = 0
+    for rule, limit in _rules():
+        capacity, rate = parse_limit(limit)
+        try:
+            allowed, wait = take(f'ratelimit:{rule}:{_client()}', capacity, rate)
+        except redis.exceptions.RedisError:
+            current_app.logger.warning('rate limiter unavailable', exc_info=True)
+            return
+        if not allowed:
+            retry_after = max(retry_after, wait)
+    if retry_after:
+        raise TooManyRequests(retry_after=math.ceil(retry_after))
+
+
+def init_app(app):
+    app.before_request(check)
@@ -1,12 +1,47 @@
+from app.cache import TwoLevelCache
+from app.search_backends import DatabaseBackend, ElasticsearchBackend, NullBackend
 from flask import current_app
+from hashlib import sha1
+import json
+import redis
+import time
+
+
+# redis list of bulk actions that still failed after every retry
+DEAD_LETTER_KEY = 'search:dead_letter'
+
+# query_index results, keyed by index version so any indexed change invalidates them
+result_cache = TwoLevelCache('search:results', 'SEARCH_CACHE')
+# column values of the rows search results are hydrated from, keyed by table and id
+row_cache = TwoLevelCache('search:rows', 'SEARCH_CACHE')
+
+
+def get_backend():
+    '''
+    returns the search backend of the current app, built on first use from the
+    SEARCH_BACKEND setting: 'elasticsearch', 'database' or 'none'. when unset,
+    elasticsearch is used if ELASTICSEARCH_URL is configured and the in-database
+    full-text index otherwise.
+    '''
+    backend = current_app.extensions.get('search_backend')
+    if backend is None:
+        name = current_app.config.get('SEARCH_BACKEND') or \
+            ('elasticsearch' if current_app.elasticsearch else 'database')
+        if name == 'elasticsearch':
+            backend = ElasticsearchBackend(current_app.elasticsearch)
+        elif name == 'database':
+            backend = DatabaseBackend()
+        else:
+            backend = NullBackend()
+        current_app.extensions['search_backend'] = backend
+    return backend
 
 
 def add_to_index(index, model):
     '''
-    can be used to add and update from elastic. will check for existence of
-    elastic config. if it exists, it will create a payload dict by creating
-    keys from the __searchable__ fields and values from the corresponding
-    fields on the db model. following that, it will index them in elastic.
+    can be used to add and update a model in the search backend. will create a
+    payload dict by creating keys from the __searchable__ fields and values from
+    the corresponding fields on the db model. following that, it will index them.
     ex: -> payload = {'body': 'this post will be indexed'}
 
     :param index:       name of the index to be added. refers to __tablename__
@@ -14,61 +49,184 @@ def add_to_index(index, model):
     :param model:       sqlalchemy session object that needs to be indexed
     :returns:
     '''
-    if not current_app.elasticsearch:
-        return
-
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    bulk([index_action(index, model)], refresh=True)
 
 
 def remove_from_index(index, model):
     '''
-    will check for existence of elastic config. if it exists, it will use the
-    index name and the model.id to delete the index from the database
+    will use the index name and the model.id to delete the model from the search backend
 
     :param index:       name of the index to be added. refers to __tablename__
                         from the model obj (e.g. - Post)
     :param model:       sqlalchemy session object that needs to be indexed
     :returns:
     '''
-    if not current_app.elasticsearch:
-        return
-
-    # using the same unique id in both elastic and sqlalchemy makes
+    # using the same unique id in both the backend and sqlalchemy makes
     # this lookup convenient by being able to reference the model.id
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    bulk([delete_action(index, model)], refresh=True)
 
 
 def query_index(index, query, page, per_page):
     '''
-    will check for existence of elastic config. if it exists,
+    runs a search against the configured backend.
 
     :param index:       name of the index to be added. refers to __tablename__
                         from the model obj (e.g. - Post)
-    :param query:       search string to be queried from elastic
+    :param query:       search string to be queried
     :param page:        refers to page number. used for returning the correct results based
                         on pagination
     :param per_page:    results per page to allow calculation for proper pagination results
     :returns:           tuple -> (lst(model.ids), int(num_of_results))
-                        if no elastic config, will return tuple with empty list and 0, otherwise,
+                        if search is disabled, will return tuple with empty list and 0, otherwise,
                         will return a list of model.ids found and total number of results
     '''
-    if not current_app.elasticsearch:
-        return [], 0
-
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={
-            # multi_match can search across multiple fields, or in
-            # this case, the entire index. allows function to be
-            # generic as different models can have different field names
-            'query': {'multi_match': {'query': query, 'fields': ['*']}},
-            # from and size arguments allow for pagination/subset calculation
-            'from': (page - 1) * per_page, 'size': per_page,
-        }
-    )
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+    return get_backend().query(index, query, page, per_page)
+
+
+def index_version(index):
+    ''' current cache version of an index, or None when redis is unavailable '''
+    try:
+        return int(current_app.redis.get(f'search:version:{index}') or 0)
+    except redis.exceptions.RedisError:
+        return None
+
+
+def bump_version(*indexes):
+    ''' invalidates every cached result of the given indexes '''
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for index in indexes:
+            pipe.incr(f'search:version:{index}')
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('could not invalidate search cache of %s', indexes)
+
+
+def cached_query_index(index, query, page, per_page):
+    '''
+    query_index behind result_cache. queries are normalized (case and whitespace)
+    before hashing, and the key carries the index version, which bulk() bumps after
+    every indexed change, so stale pages are never served after a write lands.
+
+    :returns:           same tuple as query_index
+    '''
+    version = index_version(index)
+    if version is None:
+        return query_index(index, query, page, per_page)
+    normalized = ' '.join(query.lower().split())
+    digest = sha1(normalized.encode('utf-8')).hexdigest()
+    key = f'{index}:{version}:{page}:{per_page}:{digest}'
+    result = result_cache.get(key)
+    if result is None:
+        result = query_index(index, query, page, per_page)
+        result_cache.set(key, result)
+    return result
+
+
+def index_action(index, model, fields=None):
+    '''
+    builds a bulk 'index' action for a model. the payload is built the same way as
+    in add_to_index, from the model's __searchable__ fields.
+
+    :param index:       name of the index. refers to __tablename__ of the model
+    :param model:       sqlalchemy model object, or a result row, to be indexed
+    :param fields:      fields to index, required for result rows. defaults to
+                        the model's __searchable__ fields
+    :returns:           dict -> action understood by bulk()
+    '''
+    fields = fields or model.__searchable__
+    payload = {field: getattr(model, field) for field in fields}
+    return {'op': 'index', 'index': index, 'id': model.id, 'doc': payload}
+
+
+def delete_action(index, model):
+    ''' builds a bulk 'delete' action for a model '''
+    return {'op': 'delete', 'index': index, 'id': model.id}
+
+
+def bulk(actions, refresh=False):
+    '''
+    sends a batch of index/delete actions to the search backend in one request and
+    invalidates the cached results of the indexes it touched.
+
+    :param actions:     list of dicts built by index_action and delete_action
+    :param refresh:     wait until the backend made the changes searchable before
+                        invalidating. set by the indexing of committed changes; a
+                        reindex leaves it off, every chunk would wait on a refresh
+    :returns:           list -> the actions the backend rejected, empty on success
+    '''
+    if not actions:
+        return []
+    failed = get_backend().bulk(actions, refresh=refresh)
+    bump_version(*{action['index'] for action in actions})
+    return failed
+
+
+def enqueue_bulk(actions, attempt=0, delay=None):
+    '''
+    hands a batch of actions to the task queue so the _bulk request runs off the
+    request path. if the queue can't be reached the batch is sent inline instead.
+
+    :param actions:     list of dicts built by index_action and delete_action
+    :param attempt:     number of times the batch has already failed
+    :param delay:       optional timedelta to wait before the job runs (retries)
+    :returns:
+    '''
+    if not actions:
+        return
+    if not get_backend().external:
+        # the database indexed the rows in the transaction that just committed
+        bump_version(*{action['index'] for action in actions})
+        return
+    try:
+        if delay:
+            current_app.task_queue.enqueue_in(delay, 'app.tasks.bulk_index', actions, attempt)
+        else:
+            current_app.task_queue.enqueue('app.tasks.bulk_index', actions, attempt)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('task queue unavailable, indexing inline')
+        try:
+            bulk(actions, refresh=True)
+        except Exception:
+            current_app.logger.error('inline bulk indexing failed', exc_info=True)
+
+
+def dead_letter(actions, error):
+    ''' parks a batch that exhausted its retries so it can be replayed later '''
+    current_app.redis.rpush(DEAD_LETTER_KEY, json.dumps({'actions': actions, 'error': error}))
+
+
+def replay_dead_letters():
+    '''
+    moves every dead lettered batch back onto the task queue.
+
+    :returns:           int -> number of batches requeued
+    '''
+    count = 0
+    while True:
+        entry = current_app.redis.lpop(DEAD_LETTER_KEY)
+        if entry is None:
+            return count
+        enqueue_bulk(json.loads(entry)['actions'])
+        count += 1
+
+
+def create_index(alias):
+    '''
+    creates a fresh, timestamped index to rebuild an alias into.
+
+    :param alias:       name the application queries (e.g. - 'posts')
+    :returns:           str -> name of the new index
+    '''
+    name = f'{alias}-{int(time.time())}'
+    get_backend().create_index(name)
+    return name
+
+
+def swap_alias(alias, index):
+    '''
+    points alias at a freshly built index (see ElasticsearchBackend.swap_alias)
+    and invalidates the cached results of the alias.
+    '''
+    get_backend().swap_alias(alias, index)
+    bump_version(alias)
@@ -0,0 +1,207 @@
+from app import db
+
+
+class ElasticsearchBackend(object):
+    '''
+    search backend for an elasticsearch cluster. documents are indexed by the
+    application (see app.search.bulk) and queried with multi_match.
+    '''
+    # the application has to push changes to this backend itself
+    external = True
+
+    def __init__(self, client):
+        self.client = client
+
+    def bulk(self, actions, refresh=False):
+        '''
+        sends a batch of index/delete actions in a single _bulk request. deletes of
+        documents that are already gone count as successful.
+
+        :param actions:     list of dicts built by index_action and delete_action
+        :param refresh:     return only once the changes are visible to searches
+                            (refresh=wait_for), so a search cache bumped afterwards
+                            can't be refilled with results from before the batch
+        :returns:           list -> the actions elastic rejected, empty on success
+        '''
+        body = []
+        for action in actions:
+            body.append({action['op']: {'_index': action['index'], '_id': action['id']}})
+            if action['op'] == 'index':
+                body.append(action['doc'])
+        params = {'refresh': 'wait_for'} if refresh else {}
+        response = self.client.bulk(body=body, **params)
+        if not response['errors']:
+            return []
+
+        failed = []
+        for action, item in zip(actions, response['items']):
+            result = item[action['op']]
+            already_deleted = action['op'] == 'delete' and result['status'] == 404
+            if result['status'] >= 300 and not already_deleted:
+                failed.append(action)
+        return failed
+
+    def query(self, index, query, page, per_page):
+        search = self.client.search(
+            index=index,
+            body={
+                # multi_match can search across multiple fields, or in
+                # this case, the entire index. allows function to be
+                # generic as different models can have different field names
+                'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                # from and size arguments allow for pagination/subset calculation
+                'from': (page - 1) * per_page, 'size': per_page,
+            }
+        )
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        return ids, search['hits']['total']['value']
+
+    def create_index(self, name):
+        self.client.indices.create(index=name)
+
+    def swap_alias(self, alias, index):
+        '''
+        atomically points alias at index and drops whatever served the alias before.
+        a concrete index that still carries the alias name (created before aliases were
+        used) is removed in the same request, so searches never see a gap.
+        '''
+        actions = [{'add': {'index': index, 'alias': alias}}]
+        old = []
+        if self.client.indices.exists_alias(name=alias):
+            old = [name for name in self.client.indices.get_alias(name=alias) if name != index]
+            actions += [{'remove': {'index': name, 'alias': alias}} for name in old]
+        elif self.client.indices.exists(index=alias):
+            actions.append({'remove_index': {'index': alias}})
+        self.client.indices.update_aliases(body={'actions': actions})
+        for name in old:
+            self.client.indices.delete(index=name)
+
+
+class DatabaseBackend(object):
+    '''
+    full-text search inside the application database: an FTS5 table on sqlite and
+    a GIN indexed tsvector column on postgres. both are kept up to date by the
+    database itself (triggers / generated column, see fulltext_ddl), in the same
+    transaction as the rows, so there is nothing for the application to push.
+    '''
+    external = False
+
+    def bulk(self, actions, refresh=False):
+        return []
+
+    @staticmethod
+    def _terms(query):
+        return query.split()
+
+    def query(self, index, query, page, per_page):
+        '''
+        same contract as ElasticsearchBackend.query: matches any of the terms,
+        best ranked first, one page at a time.
+
+        :returns:           tuple -> (lst(ids), int(num_of_results))
+        '''
+        terms = self._terms(query)
+        if not terms:
+            return [], 0
+        offset = (page - 1) * per_page
+        if db.engine.dialect.name == 'postgresql':
+            return self._query_postgres(index, terms, offset, per_page)
+        return self._query_sqlite(index, terms, offset, per_page)
+
+    def _query_sqlite(self, index, terms, offset, per_page):
+        # every term is quoted so fts5 query syntax in user input is matched literally
+        match = ' OR '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        table = f'{index}_fts'
+        total = db.session.execute(
+            f'SELECT count(*) FROM {table} WHERE {table} MATCH :match', {'match': match}
+        ).scalar()
+        ids = db.session.execute(
+            f'SELECT rowid FROM {table} WHERE {table} MATCH :match '
+            'ORDER BY rank LIMIT :limit OFFSET :offset',
+            {'match': match, 'limit': per_page, 'offset': offset},
+        )
+        return [id for id, in ids], total
+
+    def _query_postgres(self, index, terms, offset, per_page):
+        params = {f't{i}': term for i, term in enumerate(terms)}
+        tsquery = ' || '.join(f"plainto_tsquery('simple', :{name})" for name in params)
+        total = db.session.execute(
+            f'SELECT count(*) FROM {index} WHERE search_vector @@ ({tsquery})', params
+        ).scalar()
+        ids = db.session.execute(
+            f'SELECT id FROM {index} WHERE search_vector @@ ({tsquery}) '
+            f'ORDER BY ts_rank(search_vector, ({tsquery})) DESC, id DESC '
+            'LIMIT :limit OFFSET :offset',
+            dict(params, limit=per_page, offset=offset),
+        )
+        return [id for id, in ids], total
+
+    def rebuild(self, index):
+        ''' repopulates the fts5 table from its content table. postgres needs nothing '''
+        if db.engine.dialect.name == 'sqlite':
+            db.session.execute(f"INSERT INTO {index}_fts({index}_fts) VALUES ('rebuild')")
+            db.session.commit()
+
+
+class NullBackend(object):
+    ''' search disabled: nothing is indexed and every query comes back empty '''
+    external = False
+
+    def bulk(self, actions, refresh=False):
+        return []
+
+    def query(self, index, query, page, per_page):
+        return [], 0
+
+    def rebuild(self, index):
+        pass
+
+
+def fulltext_ddl(table, fields):
+    '''
+    statements that create the in-database full-text index of a table, per dialect,
+    run by the create_all hooks (see register_fulltext). the posts migration
+    (921186e93fb7) keeps its own copy of the statements, so that a later change
+    here can't rewrite what an already applied revision did.
+
+    :param table:       table name (e.g. - 'posts')
+    :param fields:      the model's __searchable__ fields
+    :returns:           dict -> {dialect: lst(str(create statements))}
+    '''
+    columns = ', '.join(fields)
+    new = ', '.join(f'new.{field}' for field in fields)
+    old = ', '.join(f'old.{field}' for field in fields)
+    insert = f'INSERT INTO {table}_fts(rowid, {columns}) VALUES (new.id, {new});'
+    delete = (f"INSERT INTO {table}_fts({table}_fts, rowid, {columns}) "
+              f"VALUES ('delete', old.id, {old});")
+    document = " || ' ' || ".join(f"coalesce({field}, '')" for field in fields)
+    return {
+        'sqlite': [
+            f"CREATE VIRTUAL TABLE {table}_fts USING fts5("
+            f"{columns}, content='{table}', content_rowid='id')",
+            f'CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN {insert} END',
+            f'CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN {delete} END',
+            f'CREATE TRIGGER {table}_fts_update AFTER UPDATE ON {table} '
+            f'BEGIN {delete} {insert} END',
+        ],
+        'postgresql': [
+            f'ALTER TABLE {table} ADD COLUMN search_vector tsvector '
+            f"GENERATED ALWAYS AS (to_tsvector('simple', {document})) STORED",
+            f'CREATE INDEX ix_{table}_search_vector ON {table} USING gin (search_vector)',
+        ],
+    }
+
+
+def register_fulltext(model):
+    '''
+    hooks the full-text DDL of a searchable model into metadata.create_all and
+    drop_all, so test and freshly created databases get the index too.
+    '''
+    table = model.__table__
+    for dialect, statements in fulltext_ddl(table.name, model.__searchable__).items():
+        for statement in statements:
+            db.event.listen(table, 'after_create', db.DDL(statement).execute_if(dialect=dialect))
+    db.event.listen(
+        table, 'before_drop',
+        db.DDL(f'DROP TABLE IF EXISTS {table.name}_fts').execute_if(dialect='sqlite'),
+    )
@@ -18,36 +18,75 @@ function translate(sourceElem, destElem, sourceLang, destLang) {
 }
 
 
+// translates every post on the page that still shows a translate link in one request
+function translate_all(destLang) {
+    const pending = $('[data-post-id]').filter(function() { return $(this).find('a').length })
+    if (!pending.length) return
+    const items = pending.map(function() {
+        const id = $(this).data('post-id')
+        return {id: id, text: $(`#post${id}`).text(), source_language: $(this).data('language')}
+    }).get()
+    pending.html(`<img src=${static}>`)
+    $.ajax({
+        url: '/translate/batch',
+        type: 'POST',
+        contentType: 'application/json',
+        data: JSON.stringify({dest_language: destLang, items: items}),
+    }).done(function(response) {
+        for (const id in response['translations']) {
+            $(`#translation${id}`).text(response['translations'][id])
+        }
+    }).fail(function() {
+        pending.text("{{ _('Error: Could not contact server.') }}")
+    })
+}
+
+
 const set_task_progress = (task_id, progress) => $(`#${task_id}-progress`).text(`${progress}%`)
 
 
+const handle_notification = notification => {
+    switch (notification.name) {
+        case 'unread_message_count':
+            set_message_count(notification.data)
+            break
+        case 'task_progress':
+            set_task_progress(notification.data.task_id, notification.data.progress)
+            break
+    }
+}
+
+
 window.addEventListener('DOMContentLoaded', () => {
     if (auth) {
         $(function() {
             var since = 0
-            setInterval(function() {
+            // fallback when the browser or the server can't stream
+            const poll = () => setInterval(function() {
                 $.ajax(`${url}?since=${since}`).done(
                     function(notifications) {
                         for (var i = 0; i < notifications.length; i++) {
-                            switch (notifications[i].name) {
-                                case 'unread_message_count':
-                                    set_message_count(notifications[i].data)
-                                    break
-                                case 'task_progress':
-                                    set_task_progress(
-                                        notifications[i].data.task_id,
-                                        notifications[i].data.progress
-                                    )
-                                    break
-                            }
-                            // if (notifications[i].name == 'unread_message_count') {
-                            //     set_message_count(notifications[i].data)
-                            // }
+                            handle_notification(notifications[i])
                             since = notifications[i].timestamp
                         }
                     }
                 )
             }, 10000)
+
+            if (!window.EventSource) {
+                poll()
+                return
+            }
+            const source = new EventSource(stream_url)
+            source.onmessage = function(event) {
+                const notification = JSON.parse(event.data)
+                handle_notification(notification)
+                since = notification.timestamp
+            }
+            source.onerror = function() {
+                // a closed source won't reconnect (e.g. 503 without redis)
+                if (source.readyState === EventSource.CLOSED) poll()
+            }
         })
     }
 
@@ -1,15 +1,18 @@
-from app import create_app
-from app import db
+from app import create_worker_app
+from app import db, search, timeline, translate
 from app.email_utils import send_email
-from app.models import Task, User, Post
+from app.models import Notification, Task, User, Post
+from datetime import datetime, timedelta, timezone
 from flask import render_template
+import gzip
 import json
+import os
 from rq import get_current_job
 import sys
 import time
 
 
-app = create_app()
+app = create_worker_app()
 app.app_context().push()
 
 
@@ -19,6 +22,9 @@ def _set_task_progress(progress):
         job.meta['progress'] = progress
         job.save_meta()
         task = Task.query.get(job.get_id())
+        # None until the request that queued the job commits its Task row
+        if task is None:
+            return
         task.user.add_notification(
             'task_progress',
             {'task_id': job.get_id(), 'progress': progress},
@@ -28,32 +34,56 @@ def _set_task_progress(progress):
         db.session.commit()
 
 
-def export_posts(user_id):
+def export_posts(user_id, download_url):
+    '''
+    writes the user's posts to a gzipped NDJSON file, one post per line, and emails
+    a link to it. rows are streamed from a server-side cursor on a connection of
+    their own, so the progress commits don't interrupt it, and progress is reported
+    every EXPORT_PROGRESS_STEP percent or EXPORT_PROGRESS_INTERVAL seconds at most.
+
+    :param user_id:         id of the user whose posts are exported
+    :param download_url:    external url the file will be served at, for the email
+    '''
     try:
-        # read user posts from database
-        # send email with data to user
         user = User.query.get(user_id)
         _set_task_progress(0)
-        data = []
-        i = 0
         total_posts = user.posts.count()
-        for post in user.posts.order_by(Post.timestamp.asc()):
-            data.append({
-                'body': post.body,
-                'timestamp': post.timestamp.isoformat() + 'Z'
-            })
-            time.sleep(5)
-            i += 1
-            _set_task_progress(100 * i // total_posts)
+        batch_size = app.config['EXPORT_BATCH_SIZE']
+        step = app.config['EXPORT_PROGRESS_STEP']
+        interval = app.config['EXPORT_PROGRESS_INTERVAL']
+
+        # not from the Task row: the request that queued the job may not have
+        # committed it yet
+        path = Task.export_path(user_id, get_current_job().get_id())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        query = (db.select([Post.body, Post.timestamp])
+                   .where(Post.user_id == user_id)
+                   .order_by(Post.timestamp.asc(), Post.id.asc()))
+        i, reported, reported_at = 0, 0, time.monotonic()
+        with db.engine.connect() as conn, gzip.open(path + '.part', 'wt', encoding='utf-8') as f:
+            rows = conn.execution_options(stream_results=True).execute(query)
+            for batch in iter(lambda: rows.fetchmany(batch_size), []):
+                for body, timestamp in batch:
+                    f.write(json.dumps({'body': body, 'timestamp': timestamp.isoformat() + 'Z'}))
+                    f.write('\n')
+                i += len(batch)
+                # 100 is reported once the email is out, which completes the task
+                progress = min(100 * i // total_posts, 99)
+                if progress >= reported + step or time.monotonic() - reported_at >= interval:
+                    _set_task_progress(progress)
+                    reported, reported_at = progress, time.monotonic()
+        os.replace(path + '.part', path)
+
+        # only the latest export of a user is kept
+        for name in os.listdir(os.path.dirname(path)):
+            if name != os.path.basename(path):
+                os.remove(os.path.join(os.path.dirname(path), name))
 
         send_email(
             '[Microblog] Your blog posts',
             sender=app.config['ADMINS'][0], recipients=[user.email], sync=True,
-            text_body=render_template('email/export_posts.txt', user=user),
-            html_body=render_template('email/export_posts.pug', user=user),
-            attachments=[('posts.json',
-                          'application/json',
-                          json.dumps({'posts': data}, indent=4))],
+            text_body=render_template('email/export_posts.txt', user=user, url=download_url),
+            html_body=render_template('email/export_posts.pug', user=user, url=download_url),
         )
     except: # noqa
         # handle unexpected errors
@@ -63,6 +93,131 @@ def export_posts(user_id):
         _set_task_progress(100)
 
 
+def rebuild_timeline(user_id):
+    try:
+        User.query.get(user_id).rebuild_timeline()
+    except: # noqa
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+def fan_out_post(post_id, author_id, timestamp=None):
+    '''
+    adds a post to the timelines of its author's followers, or removes a deleted
+    one (timestamp None). queued by timeline.queue_fan_out for authors with more
+    than TIMELINE_FANOUT_INLINE followers.
+    '''
+    try:
+        user_ids = Post.audience(author_id)
+        if timestamp is None:
+            timeline.remove_post(post_id, user_ids)
+        else:
+            timeline.add_post(post_id, timestamp, user_ids)
+    except: # noqa
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+def bulk_index(actions, attempt=0):
+    '''
+    sends a batch of search index actions in one _bulk request. actions that fail
+    are retried with exponential backoff and dead lettered after the last attempt.
+    '''
+    try:
+        failed = search.bulk(actions, refresh=True)
+        error = 'rejected by elasticsearch'
+    except: # noqa
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+        failed, error = actions, str(sys.exc_info()[1])
+    if not failed:
+        return
+    if attempt < app.config['SEARCH_BULK_RETRIES']:
+        search.enqueue_bulk(failed, attempt + 1, delay=timedelta(seconds=10 * 2 ** attempt))
+    else:
+        search.dead_letter(failed, error)
+
+
+def _schedule_next(name, interval):
+    '''
+    schedules the next run of a periodic job at the next multiple of interval
+    seconds. the job id carries that time: chains started by several workers
+    collapse into one, and the id is never the one of the run that is scheduling
+    it, whose hash rq would overwrite while it's still running.
+
+    :param name:        name of the task in app.tasks (e.g. - 'flush_last_seen')
+    :param interval:    seconds between two runs
+    :returns:
+    '''
+    at = (int(time.time()) // interval + 1) * interval
+    app.task_queues['low'].enqueue_at(
+        datetime.fromtimestamp(at, timezone.utc), f'app.tasks.{name}', job_id=f'{name}:{at}',
+    )
+
+
+def flush_last_seen():
+    '''
+    writes the buffered last seen times to the database, then schedules the next
+    run (see _schedule_next).
+    '''
+    try:
+        User.flush_last_seen()
+    except: # noqa
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+    finally:
+        _schedule_next('flush_last_seen', app.config['LAST_SEEN_FLUSH_INTERVAL'])
+
+
+def sweep_notifications():
+    '''
+    deletes notifications older than NOTIFICATION_RETENTION days, then schedules the
+    next run, like flush_last_seen.
+    '''
+    try:
+        Notification.sweep(time.time() - app.config['NOTIFICATION_RETENTION'] * 24 * 3600)
+    except: # noqa
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+    finally:
+        _schedule_next('sweep_notifications', app.config['NOTIFICATION_SWEEP_INTERVAL'])
+
+
+def reconcile_unread_counts():
+    '''
+    corrects drifted unread message counters, then schedules the next run, like
+    flush_last_seen.
+    '''
+    try:
+        User.reconcile_unread_counts()
+    except: # noqa
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+    finally:
+        _schedule_next('reconcile_unread_counts', app.config['UNREAD_RECONCILE_INTERVAL'])
+
+
+def detect_languages():
+    '''
+    detects the language of the posts queued by translate.queue_detection, sending
+    up to MAX_BATCH texts per request to the translator.
+    '''
+    ids = []
+    try:
+        # posts queued from now on schedule the next run
+        app.redis.delete(translate.DETECTION_SCHEDULED_KEY)
+        while True:
+            ids = translate.pop_pending_detection(translate.MAX_BATCH)
+            if not ids:
+                break
+            posts = Post.query.filter(Post.id.in_(ids), Post.language.is_(None)).all()
+            languages = translate.detect_languages([post.body for post in posts])
+            for post, language in zip(posts, languages):
+                post.language = translate.language_code(language)
+            db.session.commit()
+            ids = []
+    except: # noqa
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+        db.session.rollback()
+        # the popped batch goes back to the set and is retried by a later run
+        if ids:
+            translate.queue_detection(*ids)
+
+
 # def example(seconds):
 #     job = get_current_job()
 #     print('Starting task 1')
@@ -0,0 +1,250 @@
+from datetime import timezone
+from flask import current_app
+import redis
+
+
+# a built timeline holds the marker member 0 (no post has that id) with score -inf,
+# below every post. it tells a timeline that is warm but empty (a new user, or one
+# following nobody) apart from one that was never built, which has no key at all.
+_WARM = 0
+
+# appends entries to a timeline if it's warm, or while it is being rebuilt (KEYS[2]
+# set): the rebuild merges its rows into what arrived meanwhile, so a post committed
+# after the rebuild read the database isn't lost. other cold timelines are left
+# alone, since a partial sorted set would be trusted as complete. the marker is
+# skipped when trimming to ARGV[1] posts.
+_ADD_IF_WARM = '''
+local warm = redis.call('zscore', KEYS[1], '0')
+if not warm and redis.call('exists', KEYS[2]) == 0 then
+    return 0
+end
+for i = 2, #ARGV, 2 do
+    redis.call('zadd', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('zremrangebyrank', KEYS[1], warm and 1 or 0, -tonumber(ARGV[1]) - 1)
+return 0
+'''
+
+
+# returns the number of posts in the timeline (-1 when it's cold) and up to ARGV[2]
+# (plus any ties on the cursor score) entries on the requested side of the cursor
+# score, with their scores. '(-inf' keeps the marker out of every page.
+_READ_PAGE = '''
+if not redis.call('zscore', KEYS[1], '0') then
+    return {-1, {}}
+end
+local count = tonumber(ARGV[2])
+local total = redis.call('zcard', KEYS[1]) - 1
+if ARGV[1] == '' then
+    return {total, redis.call(
+        'zrevrangebyscore', KEYS[1], '+inf', '(-inf', 'withscores', 'limit', 0, count)}
+end
+count = count + redis.call('zcount', KEYS[1], ARGV[1], ARGV[1])
+if ARGV[3] == 'next' then
+    return {total, redis.call(
+        'zrevrangebyscore', KEYS[1], ARGV[1], '(-inf', 'withscores', 'limit', 0, count)}
+end
+return {total, redis.call(
+    'zrangebyscore', KEYS[1], ARGV[1], '+inf', 'withscores', 'limit', 0, count)}
+'''
+
+
+def _key(user_id):
+    return f'timeline:{user_id}'
+
+
+def _rebuilding_key(user_id):
+    return f'timeline:{user_id}:rebuilding'
+
+
+def _score(timestamp):
+    # timestamps are naive utc; .timestamp() alone would read them as local time
+    return timestamp.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _entries(posts):
+    '''
+    flattens (post_id, timestamp) pairs into the score/member argument list
+    expected by zadd and the _ADD_IF_WARM script.
+    '''
+    args = []
+    for post_id, timestamp in posts:
+        args.extend([_score(timestamp), post_id])
+    return args
+
+
+def add_post(post_id, timestamp, user_ids):
+    '''
+    fans a newly committed post out to the timelines of every user in user_ids
+    (the author and their followers). timelines that are cold are skipped and
+    will pick the post up when they are rebuilt.
+
+    :param post_id:     id of the new post
+    :param timestamp:   post.timestamp, used as the sorted set score
+    :param user_ids:    ids of the users whose home timelines show the post
+    :returns:
+    '''
+    add_to_timeline = current_app.redis.register_script(_ADD_IF_WARM)
+    length = current_app.config['TIMELINE_LENGTH']
+    user_ids = list(user_ids)
+    try:
+        for start in range(0, len(user_ids), 1000):
+            pipe = current_app.redis.pipeline(transaction=False)
+            for user_id in user_ids[start:start + 1000]:
+                add_to_timeline(
+                    keys=[_key(user_id), _rebuilding_key(user_id)],
+                    args=[length] + _entries([(post_id, timestamp)]),
+                    client=pipe,
+                )
+            pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('timeline fan-out failed for post %s', post_id)
+
+
+def remove_post(post_id, user_ids):
+    ''' removes a deleted post from the timelines of every user in user_ids '''
+    user_ids = list(user_ids)
+    try:
+        for start in range(0, len(user_ids), 1000):
+            pipe = current_app.redis.pipeline(transaction=False)
+            for user_id in user_ids[start:start + 1000]:
+                pipe.zrem(_key(user_id), post_id)
+            pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('timeline removal failed for post %s', post_id)
+
+
+def queue_fan_out(post_id, author_id, timestamp=None):
+    '''
+    hands the fan-out of a post whose author has more than TIMELINE_FANOUT_INLINE
+    followers to a fan_out_post job, so creating or deleting it doesn't take time
+    proportional to the followers. the author's own timeline is updated right away.
+
+    :param post_id:     id of the committed post
+    :param author_id:   id of the post's author
+    :param timestamp:   post.timestamp of a new post, None for a deleted one
+    :returns:
+    '''
+    if timestamp is None:
+        remove_post(post_id, [author_id])
+    else:
+        add_post(post_id, timestamp, [author_id])
+    try:
+        current_app.task_queues['high'].enqueue(
+            'app.tasks.fan_out_post', post_id, author_id, timestamp)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('timeline fan-out not queued for post %s', post_id)
+
+
+def backfill(user_id, posts):
+    '''
+    merges the recent posts of a newly followed user into a warm timeline.
+
+    :param user_id:     id of the follower whose timeline is updated
+    :param posts:       list of (post_id, timestamp) tuples
+    :returns:
+    '''
+    if not posts:
+        return
+    add_to_timeline = current_app.redis.register_script(_ADD_IF_WARM)
+    try:
+        add_to_timeline(
+            keys=[_key(user_id), _rebuilding_key(user_id)],
+            args=[current_app.config['TIMELINE_LENGTH']] + _entries(posts),
+        )
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('timeline backfill failed for user %s', user_id)
+
+
+def prune(user_id, post_ids):
+    ''' drops the posts of an unfollowed user from a timeline '''
+    if not post_ids:
+        return
+    try:
+        current_app.redis.zrem(_key(user_id), *post_ids)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('timeline prune failed for user %s', user_id)
+
+
+def request_rebuild(user_id):
+    '''
+    enqueues a rebuild_timeline job for a cold timeline. the rebuilding flag makes
+    it one job per user: page views while it is pending or running enqueue nothing.
+    a job that dies lets the flag expire after TIMELINE_REBUILD_TIMEOUT seconds.
+    '''
+    try:
+        if current_app.redis.set(_rebuilding_key(user_id), 1, nx=True,
+                                 ex=current_app.config['TIMELINE_REBUILD_TIMEOUT']):
+            current_app.task_queues['high'].enqueue('app.tasks.rebuild_timeline', user_id)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('timeline rebuild not queued for user %s', user_id)
+
+
+def start_rebuild(user_id):
+    '''
+    marks a timeline as being rebuilt, before its posts are read from the database.
+    fan-outs from then on are kept for rebuild to merge with.
+    '''
+    current_app.redis.set(_rebuilding_key(user_id), 1,
+                          ex=current_app.config['TIMELINE_REBUILD_TIMEOUT'])
+
+
+def rebuild(user_id, posts):
+    '''
+    warms a timeline with the given posts in one transaction: they are merged with
+    the posts fanned out since start_rebuild, trimmed to TIMELINE_LENGTH and marked
+    warm.
+
+    :param user_id:     id of the user whose timeline is rebuilt
+    :param posts:       list of (post_id, timestamp) tuples, newest first
+    :returns:
+    '''
+    pipe = current_app.redis.pipeline()
+    if posts:
+        pipe.zadd(_key(user_id), {post_id: _score(ts) for post_id, ts in posts})
+    pipe.zremrangebyrank(_key(user_id), 0, -current_app.config['TIMELINE_LENGTH'] - 1)
+    pipe.zadd(_key(user_id), {_WARM: float('-inf')})
+    pipe.delete(_rebuilding_key(user_id))
+    pipe.execute()
+
+
+def get_page(user_id, key, direction, per_page):
+    '''
+    reads one page of post ids from a user's timeline, newest first. pages are
+    addressed by the (timestamp, id) key of the row next to them, the same
+    keyset cursor used for the followed_posts fallback.
+
+    :param user_id:     id of the user whose home timeline is read
+    :param key:         (timestamp, post_id) of the cursor row or None for the first page
+    :param direction:   'next' for older posts, 'prev' for newer posts
+    :param per_page:    number of posts per page
+    :returns:           tuple -> (lst(post.ids), bool(has_more)) or None
+                        None means the caller has to fall back to the followed_posts
+                        query, either because the timeline is cold, redis is down or
+                        the page lies beyond the entries kept in the timeline
+    '''
+    read_page = current_app.redis.register_script(_READ_PAGE)
+    score = repr(_score(key[0])) if key else ''
+    try:
+        total, flat = read_page(keys=[_key(user_id)], args=[score, per_page + 1, direction])
+    except redis.exceptions.RedisError:
+        return None
+    if total < 0:
+        return None
+    entries = [(float(flat[i + 1]), int(flat[i])) for i in range(0, len(flat), 2)]
+    if key:
+        # entries sharing the cursor's score are filtered on the post id tie-breaker
+        bound = (_score(key[0]), key[1])
+        if direction == 'next':
+            entries = [e for e in entries if e < bound]
+        else:
+            entries = [e for e in entries if e > bound]
+    entries.sort(reverse=(direction == 'next'))
+    has_more = len(entries) > per_page
+    if direction == 'next' and not has_more and total >= current_app.config['TIMELINE_LENGTH']:
+        # the page runs into the trimmed tail of a full timeline
+        return None
+    entries = entries[:per_page]
+    if direction == 'prev':
+        entries.reverse()
+    return [post_id for _, post_id in entries], has_more
@@ -1,35 +1,214 @@
-import json
+from app.cache import TwoLevelCache
+from collections import Counter
+from datetime import timedelta
 from flask import current_app
 from flask_babel import _
+from hashlib import sha256
+import json
+import re
+import redis
 import requests
+from requests.adapters import HTTPAdapter
 
 
-def translate(text, source_language, dest_language):
-    if 'MS_TRANSLATOR_KEY' not in current_app.config or not current_app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: the translation service is not configured.')
-    auth = {'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY']}
-    r = requests.get(
-        'https://api.microsofttranslator.com/v2/Ajax.svc/Translate'
-        f'?text={text}&from={source_language}&to={dest_language}', headers=auth,
-    )
-    if r.status_code != 200:
-        return _('Error: the translation service failed.')
-    return json.loads(r.content.decode('utf-8-sig'))
+TRANSLATE_URL = 'https://api.cognitive.microsofttranslator.com/translate?api-version=3.0'
+DETECT_URL = 'https://api.cognitive.microsofttranslator.com/detect?api-version=3.0'
+# the translator accepts at most this many texts per request
+MAX_BATCH = 100
 
+# redis set of post ids waiting for remote language detection, and the flag that
+# marks a detect_languages job as already scheduled for them
+PENDING_DETECTION_KEY = 'language:pending'
+DETECTION_SCHEDULED_KEY = 'language:scheduled'
 
-def detect_language(text):
-    if 'MS_TRANSLATOR_KEY' not in current_app.config or not current_app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: the translation service is not configured.')
-    body = json.dumps([{"text": text}])
+# kana only occur in japanese, which mixes them with han characters (kanji): any
+# kana decide for japanese before the han ratio could suggest chinese
+_KANA = re.compile('[\u3040-\u30ff]')
+_JAPANESE = re.compile('[\u3040-\u30ff\u4e00-\u9fff]')
+# scripts that identify a single language on their own
+_SCRIPTS = [
+    ('ko', re.compile('[\uac00-\ud7af\u1100-\u11ff]')),
+    ('zh', re.compile('[\u4e00-\u9fff]')),
+    ('el', re.compile('[\u0370-\u03ff]')),
+    ('he', re.compile('[\u0590-\u05ff]')),
+    ('th', re.compile('[\u0e00-\u0e7f]')),
+]
+# the most frequent function words of common latin script languages
+_STOPWORDS = {
+    'en': 'the and is are was to of in that it for with you this have not on be at but my',
+    'es': 'el la los las y es que de en un una por para con no lo pero mi muy está',
+    'fr': 'le la les et est que de en un une pour avec ne pas je il vous mais mon très',
+    'de': 'der die das und ist nicht ich du ein eine zu mit auf für es sie aber mein sehr',
+    'it': 'il la che di e è un una per con non ma sono mi molto questo gli della',
+    'pt': 'o a os as e é que de em um uma para com não mas eu muito está você',
+}
+_STOPWORDS = {language: set(words.split()) for language, words in _STOPWORDS.items()}
+_WORD = re.compile(r'[^\W\d_]+')
+
+# translations are content addressed: the key is a hash of source, destination and text
+translation_cache = TwoLevelCache('translate', 'TRANSLATION_CACHE')
+
+# one pooled session per process, so calls reuse keep-alive connections to the api
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+
+def _configured():
+    return 'MS_TRANSLATOR_KEY' in current_app.config and current_app.config['MS_TRANSLATOR_KEY']
+
+
+def _cache_key(text, source_language, dest_language):
+    return sha256(f'{source_language}\0{dest_language}\0{text}'.encode('utf-8')).hexdigest()
+
+
+def _post(url, texts, **params):
     headers = {
         'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
         'Content-Type': 'application/json',
-        'Content-Length': str(len(text)),
     }
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com/detect?api-version=3.0',
-        headers=headers, data=body,
+    return session.post(
+        url, params=params, headers=headers,
+        data=json.dumps([{'text': text} for text in texts]),
+        timeout=current_app.config['TRANSLATOR_TIMEOUT'],
     )
-    if r.status_code != 200:
-        return 'UNKNOWN'
-    return json.loads(r.content.decode('utf-8-sig'))[0]['language']
+
+
+def translate(text, source_language, dest_language):
+    return translate_batch([(text, source_language)], dest_language)[0]
+
+
+def translate_batch(items, dest_language):
+    '''
+    translates several texts into one language. cached translations are served
+    from translation_cache; the misses are sent to the translator in one request
+    per source language.
+
+    :param items:           list of (text, source_language) tuples
+    :param dest_language:   language to translate into
+    :returns:               list -> translated texts (or error messages), in item order
+    '''
+    if not _configured():
+        return [_('Error: the translation service is not configured.')] * len(items)
+
+    keys = [_cache_key(text, source, dest_language) for text, source in items]
+    cached = translation_cache.get_many(keys)
+    results = [cached[key] for key in keys]
+
+    pending = {}
+    for i, (text, source) in enumerate(items):
+        if results[i] is None:
+            pending.setdefault(source, []).append(i)
+
+    translated = {}
+    for source, positions in pending.items():
+        for start in range(0, len(positions), MAX_BATCH):
+            chunk = positions[start:start + MAX_BATCH]
+            try:
+                r = _post(TRANSLATE_URL, [items[i][0] for i in chunk],
+                          to=dest_language, **{'from': source})
+            except requests.exceptions.RequestException:
+                r = None
+            if r is None or r.status_code != 200:
+                for i in chunk:
+                    results[i] = _('Error: the translation service failed.')
+                continue
+            for i, result in zip(chunk, json.loads(r.content.decode('utf-8-sig'))):
+                results[i] = result['translations'][0]['text']
+                translated[keys[i]] = results[i]
+
+    if translated:
+        translation_cache.set_many(translated)
+    return results
+
+
+def detect_language(text):
+    return detect_languages([text])[0]
+
+
+def detect_languages(texts):
+    '''
+    asks the translator for the language of several texts, MAX_BATCH per request.
+
+    :param texts:           list of texts
+    :returns:               list -> language codes, 'UNKNOWN' where detection failed
+    '''
+    # runs in rq jobs too, where there's no request for gettext to pick a locale from
+    if not _configured():
+        return ['UNKNOWN'] * len(texts)
+    results = []
+    for start in range(0, len(texts), MAX_BATCH):
+        chunk = texts[start:start + MAX_BATCH]
+        try:
+            r = _post(DETECT_URL, chunk)
+        except requests.exceptions.RequestException:
+            r = None
+        if r is None or r.status_code != 200:
+            results += ['UNKNOWN'] * len(chunk)
+        else:
+            results += [result['language'] for result in json.loads(r.content.decode('utf-8-sig'))]
+    return results
+
+
+def guess_language(text):
+    '''
+    cheap local language detection, tried before the translator is asked. texts in a
+    script used by only one language are decided by the script; latin texts by
+    counting common function words. only answers when the evidence is clear.
+
+    :param text:            text to classify
+    :returns:               str -> language code, or None when unsure
+    '''
+    letters = [char for char in text if char.isalpha()]
+    if not letters:
+        return None
+    if _KANA.search(text) and len(_JAPANESE.findall(text)) * 2 > len(letters):
+        return 'ja'
+    for language, script in _SCRIPTS:
+        if len(script.findall(text)) * 2 > len(letters):
+            return language
+
+    words = _WORD.findall(text.lower())
+    hits = Counter()
+    for word in words:
+        for language, stopwords in _STOPWORDS.items():
+            if word in stopwords:
+                hits[language] += 1
+    ranked = hits.most_common(2) + [(None, 0), (None, 0)]
+    (best, count), runner_up = ranked[0], ranked[1][1]
+    # at least two hits, a fifth of the words, and twice the next best language
+    if count >= 2 and count * 5 >= len(words) and count >= 2 * runner_up:
+        return best
+    return None
+
+
+def language_code(detected):
+    ''' maps a detection result to what Post.language stores: '' when unknown '''
+    if not detected or detected == 'UNKNOWN' or len(detected) > 5:
+        return ''
+    return detected
+
+
+def queue_detection(*post_ids):
+    '''
+    adds posts to the set awaiting remote detection, and schedules one
+    detect_languages job for everything that arrives within LANGUAGE_DETECT_DELAY.
+    without redis or a configured translator the posts keep an unknown language.
+    '''
+    if not _configured():
+        return
+    delay = current_app.config['LANGUAGE_DETECT_DELAY']
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.sadd(PENDING_DETECTION_KEY, *post_ids)
+        pipe.set(DETECTION_SCHEDULED_KEY, 1, nx=True, ex=delay + 60)
+        _, schedule = pipe.execute()
+        if schedule:
+            current_app.task_queue.enqueue_in(
+                timedelta(seconds=delay), 'app.tasks.detect_languages')
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('could not queue language detection of posts %s', post_ids)
+
+
+def pop_pending_detection(count):
+    ''' removes and returns up to count post ids awaiting detection '''
+    return [int(id) for id in current_app.redis.spop(PENDING_DETECTION_KEY, count) or []]
@@ -0,0 +1,75 @@
+'''
+cost of the avatar urls on the post listing render path: one url built from the
+stored digest against one md5 of the email per call, on their own and inside a
+page of posts rendered through _post.pug.
+
+    python benchmarks/avatar.py [--posts 25] [--runs 200]
+'''
+import argparse
+from hashlib import md5
+import os
+import statistics
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from app.models import Post, User  # noqa: E402
+from config import Config  # noqa: E402
+from flask import g, render_template_string  # noqa: E402
+
+
+PAGE = '''
+{% set avatars = avatar_urls(posts|map(attribute='author'), 70) %}
+{% for post in posts %}{% include '_post.pug' %}{% endfor %}
+'''
+
+
+def hashed_avatar(user, size):
+    # User.avatar before the digest was stored
+    digest = md5(user.email.lower().encode('utf-8')).hexdigest()
+    return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+
+
+def hashed_avatar_urls(users, size):
+    return {user.id: hashed_avatar(user, size) for user in users}
+
+
+def median_us(fn, runs, number=1):
+    timings = timeit.repeat(fn, repeat=runs, number=number)
+    return statistics.median(timings) / number * 1000000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--posts', type=int, default=25)
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args()
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite://'
+        ELASTICSEARCH_URL = None
+
+    app = create_app(BenchConfig)
+    users = [User(id=i, username=f'user{i}', email=f'User{i}@Example.com')
+             for i in range(args.posts)]
+    posts = [Post(id=i, body='a post', author=user) for i, user in enumerate(users)]
+
+    with app.test_request_context():
+        g.locale = 'en'
+        render_template_string(PAGE, posts=posts)
+        results = [
+            ('one url, md5', median_us(lambda: hashed_avatar(users[0], 70), args.runs, 1000)),
+            ('one url, stored', median_us(lambda: users[0].avatar(70), args.runs, 1000)),
+            (f'{args.posts} urls, md5', median_us(
+                lambda: hashed_avatar_urls(users, 70), args.runs, 100)),
+            (f'{args.posts} urls, stored', median_us(
+                lambda: User.avatar_urls(users, 70), args.runs, 100)),
+            ('page, md5', median_us(lambda: render_template_string(
+                PAGE, posts=posts, avatar_urls=hashed_avatar_urls), args.runs)),
+            ('page, stored', median_us(
+                lambda: render_template_string(PAGE, posts=posts), args.runs)),
+        ]
+    for name, us in results:
+        print(f'{name:>18}: {us:9.1f} us')
@@ -0,0 +1,107 @@
+'''
+follow graph queries on a seeded graph, with the followers table as it was (no key,
+no index) and with its primary key and indexes: the first page of followed_posts,
+is_following and the follower count.
+
+    python benchmarks/followers.py [--users 20000] [--follows 50] [--posts 10] [--runs 20]
+
+the defaults seed a million follows and 200,000 posts into two sqlite files in a
+temporary directory; seeding takes a while, the queries are timed afterwards.
+'''
+import argparse
+from datetime import datetime, timedelta
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db  # noqa: E402
+from app.models import Post, User  # noqa: E402
+from app.pagination import paginate_keyset  # noqa: E402
+from config import Config  # noqa: E402
+
+
+# the followers table and posts indexes before the primary key migration
+BEFORE = [
+    'DROP INDEX ix_followers_followed_id_follower_id',
+    'DROP INDEX ix_posts_user_id_timestamp',
+    'DROP TABLE followers',
+    'CREATE TABLE followers (follower_id INTEGER REFERENCES users (id), '
+    'followed_id INTEGER REFERENCES users (id))',
+]
+
+
+def seed(path, schema, users, follows, posts, rng_seed):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        ELASTICSEARCH_URL = None
+        SEARCH_BACKEND = 'none'
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        connection = db.engine.raw_connection()
+        for statement in schema:
+            connection.execute(statement)
+        rng = random.Random(rng_seed)
+        connection.executemany(
+            'INSERT INTO users (id, username, email) VALUES (?, ?, ?)',
+            ((id, f'user{id}', f'user{id}@example.com') for id in range(1, users + 1)))
+        connection.executemany(
+            'INSERT INTO followers (follower_id, followed_id) VALUES (?, ?)',
+            ((follower, followed) for follower in range(1, users + 1)
+             for followed in rng.sample(range(1, users + 1), follows)))
+        start = datetime(2020, 1, 1)
+        connection.executemany(
+            'INSERT INTO posts (body, user_id, timestamp) VALUES (?, ?, ?)',
+            (('post', rng.randint(1, users), str(start + timedelta(seconds=i)))
+             for i in range(users * posts)))
+        connection.commit()
+        connection.execute('ANALYZE')
+        connection.close()
+    return app
+
+
+def measure(app, users, runs, rng_seed):
+    rng = random.Random(rng_seed)
+    timings = {'followed_posts': [], 'is_following': [], 'followers.count': []}
+    with app.app_context():
+        for _ in range(runs):
+            user = User.query.get(rng.randint(1, users))
+            other = User.query.get(rng.randint(1, users))
+            for name, query in (
+                ('followed_posts', lambda: paginate_keyset(
+                    user.followed_posts(), [Post.timestamp, Post.id], None,
+                    app.config['POSTS_PER_PAGE'])),
+                ('is_following', lambda: user.is_following(other)),
+                ('followers.count', lambda: user.followers.count()),
+            ):
+                start = time.perf_counter()
+                query()
+                timings[name].append((time.perf_counter() - start) * 1000)
+            db.session.remove()
+    return {name: statistics.median(values) for name, values in timings.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=50)
+    parser.add_argument('--posts', type=int, default=10)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        results = {}
+        for name, schema in (('before', BEFORE), ('after', [])):
+            app = seed(os.path.join(directory, f'{name}.db'), schema,
+                       args.users, args.follows, args.posts, rng_seed=1)
+            results[name] = measure(app, args.users, args.runs, rng_seed=2)
+    print(f'{args.users * args.follows} follows, {args.users * args.posts} posts, '
+          f'median of {args.runs} runs')
+    print(f'{"query":>16} {"before ms":>10} {"after ms":>10}')
+    for query in results['before']:
+        print(f'{query:>16} {results["before"][query]:10.2f} {results["after"][query]:10.2f}')
@@ -0,0 +1,52 @@
+'''
+job start latency of the rq work horse: the time from a fresh interpreter to an
+app ready to run a job, for the full web app factory and the worker one.
+
+    python benchmarks/job_start.py [--runs 20]
+
+each run is a separate process, like a work horse that has to import app.tasks.
+'''
+import argparse
+import statistics
+import subprocess
+import sys
+
+
+SETUP = {
+    'create_app': 'from app import create_app as factory',
+    'create_worker_app': 'from app import create_worker_app as factory',
+}
+
+# what app.tasks does on import, followed by a first use of the database
+PROGRAM = '''
+import time
+start = time.perf_counter()
+{setup}
+flask_app = factory()
+flask_app.app_context().push()
+from app.models import db
+db.session.execute('SELECT 1')
+print(time.perf_counter() - start)
+'''
+
+
+def measure(setup, runs):
+    timings = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, '-c', PROGRAM.format(setup=setup)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        timings.append(float(out.splitlines()[-1]) * 1000)
+    return timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('factories', nargs='*', default=list(SETUP))
+    args = parser.parse_args()
+    for name in args.factories:
+        timings = measure(SETUP[name], args.runs)
+        print(f'{name:>18}: median {statistics.median(timings):7.1f} ms, '
+              f'min {min(timings):7.1f} ms over {args.runs} runs')
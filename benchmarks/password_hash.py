@@ -0,0 +1,53 @@
+'''
+cost of each password hash setting: milliseconds per hash on one thread, and
+checks per second when a pool of threads verifies passwords concurrently.
+
+    python benchmarks/password_hash.py [--runs 10] [--workers 4] [method ...]
+
+pick PASSWORD_HASH_METHOD so one check stays well below the login latency you
+can afford, and PASSWORD_HASH_WORKERS so the pool fits the cpus left for requests.
+'''
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import statistics
+import time
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+METHODS = [
+    'pbkdf2:sha256:50000',
+    'pbkdf2:sha256:150000',
+    'pbkdf2:sha256:260000',
+    'pbkdf2:sha256:600000',
+]
+
+
+def per_hash(method, runs):
+    pwhash = generate_password_hash('correct horse battery staple', method, 16)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        check_password_hash(pwhash, 'correct horse battery staple')
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), pwhash
+
+
+def throughput(pwhash, workers, checks):
+    with ThreadPoolExecutor(workers) as pool:
+        start = time.perf_counter()
+        list(pool.map(lambda _: check_password_hash(pwhash, 'wrong'), range(checks)))
+        return checks / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('methods', nargs='*', default=METHODS)
+    args = parser.parse_args()
+    print(f'{"method":>24} {"ms/check":>9} {"checks/s":>9} ({args.workers} threads)')
+    for method in args.methods:
+        ms, pwhash = per_hash(method, args.runs)
+        rate = throughput(pwhash, args.workers, args.runs * args.workers)
+        print(f'{method:>24} {ms:9.1f} {rate:9.1f}')
@@ -0,0 +1,74 @@
+'''
+template time of a page of posts: every post rendered through _post.pug (the include
+loop the pages used before), against app.fragments.render_posts with its cache cold
+and with every fragment in the process cache.
+
+    python benchmarks/post_fragments.py [--posts 25] [--runs 200]
+
+the cold run also pays for the redis round-trips, so it depends on REDIS_URL.
+'''
+import argparse
+import os
+import statistics
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, fragments  # noqa: E402
+from app.models import Post, User  # noqa: E402
+from config import Config  # noqa: E402
+from flask import g, render_template_string  # noqa: E402
+
+
+INCLUDE = '''
+{% set avatars = avatar_urls(posts|map(attribute='author'), 70) %}
+{% for post in posts %}{% include '_post.pug' %}{% endfor %}
+'''
+CACHED = '{{ render_posts(posts) }}'
+
+
+def median_ms(fn, runs, before=None):
+    timings = []
+    for _ in range(runs):
+        if before:
+            before()
+        timings.append(timeit.timeit(fn, number=1))
+    return statistics.median(timings) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--posts', type=int, default=25)
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args()
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite://'
+        ELASTICSEARCH_URL = None
+
+    app = create_app(BenchConfig)
+    users = [User(id=i, username=f'user{i}', email=f'user{i}@example.com')
+             for i in range(args.posts)]
+    posts = [Post(id=i, body='a post ' * 10, author=user, language='es')
+             for i, user in enumerate(users)]
+
+    def clear():
+        keys = [fragments._key(post) for post in posts]
+        fragments.post_cache.delete(*keys)
+
+    with app.test_request_context():
+        g.locale = 'en'
+        render_template_string(INCLUDE, posts=posts)
+        render_template_string(CACHED, posts=posts)
+        results = [
+            ('include loop', median_ms(
+                lambda: render_template_string(INCLUDE, posts=posts), args.runs)),
+            ('fragments, cold', median_ms(
+                lambda: render_template_string(CACHED, posts=posts), args.runs, clear)),
+            ('fragments, warm', median_ms(
+                lambda: render_template_string(CACHED, posts=posts), args.runs)),
+        ]
+    print(f'{args.posts} posts, median of {args.runs} renders')
+    for name, ms in results:
+        print(f'{name:>16}: {ms:7.2f} ms')
@@ -10,10 +10,84 @@ basedir = Path().cwd()
 class Config(object):
     LANGUAGES = ['en', 'es']
     POSTS_PER_PAGE = 15
+    # number of most recent posts kept in each user's materialized home timeline
+    TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH') or 800)
+    # seconds a cold timeline waits for its rebuild job before another one is queued
+    TIMELINE_REBUILD_TIMEOUT = int(os.environ.get('TIMELINE_REBUILD_TIMEOUT') or 300)
+    # followers a new or deleted post is fanned out to by the request itself; the
+    # posts of authors with more are fanned out by a job on the high queue
+    TIMELINE_FANOUT_INLINE = int(os.environ.get('TIMELINE_FANOUT_INLINE') or 100)
+    # seconds between last_seen writes for the same user, and between buffer flushes
+    LAST_SEEN_RESOLUTION = int(os.environ.get('LAST_SEEN_RESOLUTION') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 60)
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
     REDISTOGO_URL = os.environ.get('REDISTOGO_URL') or REDIS_URL
+    # rq queues by priority, highest first: workers always drain them in this order
+    TASK_QUEUES = {
+        'high': 'flask_blog-high',
+        'default': 'flask_blog-tasks',
+        'low': 'flask_blog-low',
+    }
+    # queue of each task started with User.launch_task, 'default' when not listed
+    TASK_PRIORITIES = {'export_posts': 'low'}
+    # worker processes started by worker.py, the cpu count when unset
+    RQ_WORKERS = int(os.environ.get('RQ_WORKERS') or 0) or None
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # 'elasticsearch', 'database' (sqlite fts5 / postgres tsvector) or 'none'. defaults to
+    # elasticsearch when ELASTICSEARCH_URL is set and to the database otherwise
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    # retries of a failed _bulk request before its actions are dead lettered
+    SEARCH_BULK_RETRIES = int(os.environ.get('SEARCH_BULK_RETRIES') or 3)
+    # rows per _bulk request and concurrent _bulk requests of SearchableMixin.reindex
+    SEARCH_REINDEX_BATCH_SIZE = int(os.environ.get('SEARCH_REINDEX_BATCH_SIZE') or 500)
+    SEARCH_REINDEX_WORKERS = int(os.environ.get('SEARCH_REINDEX_WORKERS') or 4)
+    # search result and row caches: seconds in redis, seconds in process, process entries
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 300)
+    SEARCH_CACHE_LOCAL_TTL = int(os.environ.get('SEARCH_CACHE_LOCAL_TTL') or 30)
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1024)
+    # seconds between keep-alive comments, and lifetime of a notification stream
+    NOTIFICATION_HEARTBEAT = int(os.environ.get('NOTIFICATION_HEARTBEAT') or 15)
+    NOTIFICATION_STREAM_TIMEOUT = int(os.environ.get('NOTIFICATION_STREAM_TIMEOUT') or 300)
+    # seconds a user's latest notifications stay cached in redis
+    NOTIFICATION_CACHE_TTL = int(os.environ.get('NOTIFICATION_CACHE_TTL') or 24 * 3600)
+    # days notifications are kept, and seconds between sweeps of older ones
+    NOTIFICATION_RETENTION = int(os.environ.get('NOTIFICATION_RETENTION') or 30)
+    NOTIFICATION_SWEEP_INTERVAL = int(os.environ.get('NOTIFICATION_SWEEP_INTERVAL') or 3600)
+    # seconds between recounts of the unread message counters
+    UNREAD_RECONCILE_INTERVAL = int(os.environ.get('UNREAD_RECONCILE_INTERVAL') or 3600)
+    # api token lookups: seconds in redis and in process, process entries. a revoked
+    # token can be accepted by other processes for up to TOKEN_CACHE_LOCAL_TTL seconds
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL') or 300)
+    TOKEN_CACHE_LOCAL_TTL = 5
+    TOKEN_CACHE_SIZE = 10000
+    # seconds a user's followed ids stay cached in redis for is_following
+    FOLLOW_CACHE_TTL = int(os.environ.get('FOLLOW_CACHE_TTL') or 24 * 3600)
+    # per-user cache of the unread count and running tasks shown on every page
+    CHROME_CACHE_TTL = int(os.environ.get('CHROME_CACHE_TTL') or 10)
+    CHROME_CACHE_LOCAL_TTL = 2
+    CHROME_CACHE_SIZE = 4096
+    # rendered posts (see app.fragments): seconds in redis and in process, process entries
+    POST_FRAGMENT_CACHE_TTL = int(os.environ.get('POST_FRAGMENT_CACHE_TTL') or 24 * 3600)
+    POST_FRAGMENT_CACHE_LOCAL_TTL = 300
+    POST_FRAGMENT_CACHE_SIZE = 4096
+    # where export_posts writes its files, posts read per round-trip, and how often
+    # progress is reported: every EXPORT_PROGRESS_STEP percent or INTERVAL seconds.
+    # the worker writes the files and the web process serves them, so EXPORT_DIR has
+    # to be storage both mount (a shared volume in docker-compose.yml; heroku dynos
+    # have separate ephemeral disks, so it needs a mounted shared filesystem there)
+    EXPORT_DIR = os.environ.get('EXPORT_DIR') or str(basedir.joinpath('exports'))
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE') or 1000)
+    EXPORT_PROGRESS_STEP = 5
+    EXPORT_PROGRESS_INTERVAL = 2
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    # (connect, read) timeout in seconds of translator api calls
+    TRANSLATOR_TIMEOUT = (3.05, 10)
+    # seconds new posts wait so their language is detected together in one request
+    LANGUAGE_DETECT_DELAY = int(os.environ.get('LANGUAGE_DETECT_DELAY') or 5)
+    # translations never change, so they can live in the cache for a long time
+    TRANSLATION_CACHE_TTL = int(os.environ.get('TRANSLATION_CACHE_TTL') or 7 * 24 * 3600)
+    TRANSLATION_CACHE_LOCAL_TTL = 3600
+    TRANSLATION_CACHE_SIZE = 4096
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
@@ -22,6 +96,29 @@ class Config(object):
     ADMINS = os.environ.get('ADMINS', '').split(',')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
+    # werkzeug hash method with its cost (pbkdf2:<hash>:<iterations>) and salt length.
+    # hashes made with other settings are upgraded when their user next logs in.
+    # see benchmarks/password_hash.py for the cost of each setting
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:150000'
+    PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH') or 16)
+    # threads hashing passwords (the cpu count when unset), and seconds a login waits
+    # for one before it's answered with 503
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 0) or None
+    PASSWORD_HASH_TIMEOUT = int(os.environ.get('PASSWORD_HASH_TIMEOUT') or 5)
+    # proxies in front of the app that append X-Forwarded-For: 1 for the heroku router,
+    # 0 when clients connect directly (the headers would be theirs to forge)
+    PROXY_COUNT = int(os.environ.get('PROXY_COUNT') or 1)
+    # 'redis' (shared by every process) or 'memory' (per process, for tests)
+    RATELIMIT_BACKEND = os.environ.get('RATELIMIT_BACKEND') or 'redis'
+    # token buckets per client (user, or ip when signed out), keyed by endpoint or
+    # blueprint and optionally a method: '<count>/<second|minute|hour|day>'
+    RATELIMITS = {
+        'POST auth.login': '10/minute',
+        'api.get_token': '10/minute',
+        'POST api.create_user': '5/hour',
+        'main.translate_text': '60/minute',
+        'main.translate_batch_text': '20/minute',
+    }
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + str(basedir.joinpath('app.db'))
         # 'sqllite:///' + basedir.joinpath('app.db').as_posix() # noqa
@@ -0,0 +1,57 @@
+"""posts full text search
+
+Revision ID: 921186e93fb7
+Revises: 2aa1be7cf8c4
+Create Date: 2026-10-18 12:04:51.318215
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '921186e93fb7'
+down_revision = '2aa1be7cf8c4'
+branch_labels = None
+depends_on = None
+
+
+# the statements are app.search_backends.fulltext_ddl('posts', ['body']) as of this
+# revision, copied rather than imported so the revision stays what was applied
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE posts_fts USING fts5(body, content='posts', content_rowid='id')"
+        )
+        op.execute(
+            'CREATE TRIGGER posts_fts_insert AFTER INSERT ON posts BEGIN '
+            'INSERT INTO posts_fts(rowid, body) VALUES (new.id, new.body); END'
+        )
+        op.execute(
+            'CREATE TRIGGER posts_fts_delete AFTER DELETE ON posts BEGIN '
+            "INSERT INTO posts_fts(posts_fts, rowid, body) VALUES ('delete', old.id, old.body); END"
+        )
+        op.execute(
+            'CREATE TRIGGER posts_fts_update AFTER UPDATE ON posts BEGIN '
+            "INSERT INTO posts_fts(posts_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+            'INSERT INTO posts_fts(rowid, body) VALUES (new.id, new.body); END'
+        )
+        op.execute("INSERT INTO posts_fts(posts_fts) VALUES ('rebuild')")
+    elif dialect == 'postgresql':
+        op.execute(
+            'ALTER TABLE posts ADD COLUMN search_vector tsvector '
+            "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(body, ''))) STORED"
+        )
+        op.execute('CREATE INDEX ix_posts_search_vector ON posts USING gin (search_vector)')
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('DROP TRIGGER IF EXISTS posts_fts_update')
+        op.execute('DROP TRIGGER IF EXISTS posts_fts_delete')
+        op.execute('DROP TRIGGER IF EXISTS posts_fts_insert')
+        op.execute('DROP TABLE IF EXISTS posts_fts')
+    elif dialect == 'postgresql':
+        op.execute('DROP INDEX IF EXISTS ix_posts_search_vector')
+        op.execute('ALTER TABLE posts DROP COLUMN IF EXISTS search_vector')
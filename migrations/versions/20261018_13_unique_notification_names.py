@@ -0,0 +1,28 @@
+"""unique notification names
+
+Revision ID: 5c0e8b7d41a2
+Revises: 921186e93fb7
+Create Date: 2026-10-18 13:10:22.604518
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5c0e8b7d41a2'
+down_revision = '921186e93fb7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep only the latest notification of each name before making (user_id, name) unique
+    op.execute(
+        'DELETE FROM notifications WHERE id NOT IN '
+        '(SELECT max(id) FROM notifications GROUP BY user_id, name)'
+    )
+    op.create_index('ix_notifications_user_id_name', 'notifications', ['user_id', 'name'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_notifications_user_id_name', table_name='notifications')
@@ -0,0 +1,32 @@
+"""unread message count
+
+Revision ID: 8d3f62a9c7e1
+Revises: 5c0e8b7d41a2
+Create Date: 2026-10-18 14:02:47.913350
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3f62a9c7e1'
+down_revision = '5c0e8b7d41a2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_messages_recipient_id_timestamp', 'messages', ['recipient_id', 'timestamp'], unique=False)
+    op.add_column('users', sa.Column('unread_message_count', sa.Integer(), server_default='0', nullable=True))
+    op.execute(
+        'UPDATE users SET unread_message_count = ('
+        'SELECT count(messages.id) FROM messages WHERE messages.recipient_id = users.id '
+        'AND (users.last_message_read_time IS NULL '
+        'OR messages.timestamp > users.last_message_read_time))'
+    )
+
+
+def downgrade():
+    op.drop_column('users', 'unread_message_count')
+    op.drop_index('ix_messages_recipient_id_timestamp', table_name='messages')
@@ -0,0 +1,39 @@
+"""hash api tokens
+
+Revision ID: 3b9f1c2d7a64
+Revises: 8d3f62a9c7e1
+Create Date: 2026-10-18 15:21:05.448172
+
+"""
+from alembic import op
+from hashlib import sha256
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9f1c2d7a64'
+down_revision = '8d3f62a9c7e1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.alter_column('token', type_=sa.String(length=64),
+                              existing_type=sa.String(length=32), existing_nullable=True)
+    # tokens already handed out keep working: store their hash in place
+    conn = op.get_bind()
+    users = sa.table('users', sa.column('id', sa.Integer), sa.column('token', sa.String))
+    for id, token in conn.execute(sa.select([users.c.id, users.c.token])
+                                    .where(users.c.token.isnot(None))).fetchall():
+        conn.execute(users.update()
+                          .where(users.c.id == id)
+                          .values(token=sha256(token.encode('utf-8')).hexdigest()))
+
+
+def downgrade():
+    # hashes can't be turned back into tokens, so every token is dropped
+    op.execute('UPDATE users SET token = NULL')
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.alter_column('token', type_=sa.String(length=32),
+                              existing_type=sa.String(length=64), existing_nullable=True)
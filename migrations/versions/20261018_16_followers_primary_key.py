@@ -0,0 +1,48 @@
+"""followers primary key
+
+Revision ID: 6e2a4d9b1f03
+Revises: 3b9f1c2d7a64
+Create Date: 2026-10-18 16:02:47.913260
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2a4d9b1f03'
+down_revision = '3b9f1c2d7a64'
+branch_labels = None
+depends_on = None
+
+
+def _copy_followers(primary_key):
+    # sqlite can't add a primary key to a table, so the rows are copied into a new
+    # one; DISTINCT drops duplicate follows and the rows without one of the users
+    op.create_table('followers_copy',
+    sa.Column('follower_id', sa.Integer(), nullable=not primary_key),
+    sa.Column('followed_id', sa.Integer(), nullable=not primary_key),
+    sa.ForeignKeyConstraint(['followed_id'], ['users.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['users.id'], ),
+    *([sa.PrimaryKeyConstraint('follower_id', 'followed_id', name='pk_followers')]
+      if primary_key else [])
+    )
+    op.execute(
+        'INSERT INTO followers_copy (follower_id, followed_id) '
+        'SELECT DISTINCT follower_id, followed_id FROM followers '
+        'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL'
+    )
+    op.drop_table('followers')
+    op.rename_table('followers_copy', 'followers')
+
+
+def upgrade():
+    _copy_followers(primary_key=True)
+    op.create_index('ix_followers_followed_id_follower_id', 'followers', ['followed_id', 'follower_id'], unique=False)
+    op.create_index('ix_posts_user_id_timestamp', 'posts', ['user_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_posts_user_id_timestamp', table_name='posts')
+    op.drop_index('ix_followers_followed_id_follower_id', table_name='followers')
+    _copy_followers(primary_key=False)
@@ -0,0 +1,35 @@
+"""user avatar hash
+
+Revision ID: 0c7d5e3a9b28
+Revises: 6e2a4d9b1f03
+Create Date: 2026-10-18 17:12:09.337418
+
+"""
+from alembic import op
+from hashlib import md5
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0c7d5e3a9b28'
+down_revision = '6e2a4d9b1f03'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('avatar_hash', sa.String(length=32), nullable=True))
+    # the digest of the existing emails, as User._set_email stores it
+    conn = op.get_bind()
+    users = sa.table('users', sa.column('id', sa.Integer), sa.column('email', sa.String),
+                     sa.column('avatar_hash', sa.String))
+    for id, email in conn.execute(sa.select([users.c.id, users.c.email])
+                                    .where(users.c.email.isnot(None))).fetchall():
+        conn.execute(users.update()
+                          .where(users.c.id == id)
+                          .values(avatar_hash=md5(email.lower().encode('utf-8')).hexdigest()))
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('avatar_hash')
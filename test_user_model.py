@@ -1,13 +1,23 @@
 from app import create_app, db
-from app.models import User, Post
+from app.models import User, Post, token_cache
+from app.pagination import paginate_keyset
+from app.cache import TwoLevelCache
+from app.search import result_cache, row_cache
+from app.search_backends import ElasticsearchBackend
+from app.translate import guess_language
 from config import Config
+from app import follow_graph, last_seen, search, timeline
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import event
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     ELASTICSEARCH_URL = None
+    RATELIMIT_BACKEND = 'memory'
     # will have sqlite use an in-memory db for testing
 
 
@@ -16,8 +26,55 @@ app = create_app(TestConfig)
 # with app.app_context():
 
 
+@contextmanager
+def count_queries():
+    '''
+    collects the sql statements run inside the block.
+    with count_queries() as queries: ... then len(queries)
+    '''
+    queries = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    engine = db.get_engine(app)
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield queries
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+@contextmanager
+def assert_max_queries(count):
+    ''' fails when the block runs more than count sql statements '''
+    with count_queries() as queries:
+        yield
+    assert len(queries) <= count, f'{len(queries)} queries:\n' + '\n'.join(queries)
+
+
+@contextmanager
+def fake_redis():
+    ''' points app.redis and the task queues at a fakeredis server for the block '''
+    fakeredis = pytest.importorskip('fakeredis')
+    connection = fakeredis.FakeRedis()
+    saved = app.redis, {name: queue.connection for name, queue in app.task_queues.items()}
+    app.redis = connection
+    for queue in app.task_queues.values():
+        queue.connection = connection
+    try:
+        yield connection
+    finally:
+        app.redis = saved[0]
+        for name, queue in app.task_queues.items():
+            queue.connection = saved[1][name]
+
+
 # setup function that will run prior to each function test
 def setup_function():
+    # process caches must not serve rows of another test's database
+    for cache in (result_cache, row_cache, token_cache):
+        cache._local = None
     with app.app_context():
         db.create_all()
 
@@ -42,6 +99,12 @@ def test_avatar():
         'https://www.gravatar.com/avatar/d4c74594d'
         '841139328695756648b6bd6?d=identicon&s=128'
     )
+    # the stored digest follows the email
+    u.email = 'JOHN@example.com'
+    assert u.avatar(64).startswith('https://www.gravatar.com/avatar/d4c74594d')
+    u.email = 'susan@example.com'
+    assert not u.avatar(64).startswith('https://www.gravatar.com/avatar/d4c74594d')
+    assert User.avatar_urls([u], 64) == {u.id: u.avatar(64)}
 
 
 def test_follow():
@@ -103,3 +166,417 @@ def test_follow_posts():
         assert f2 == [p2, p3]
         assert f3 == [p3, p4]
         assert f4 == [p4]
+
+
+def test_keyset_pagination():
+    with app.app_context():
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+
+        # five posts, two of them sharing a timestamp to exercise the id tie-breaker
+        now = datetime.utcnow()
+        posts = [
+            Post(body='post 1', author=u1, timestamp=now + timedelta(seconds=1)),
+            Post(body='post 2', author=u2, timestamp=now + timedelta(seconds=2)),
+            Post(body='post 3', author=u2, timestamp=now + timedelta(seconds=2)),
+            Post(body='post 4', author=u1, timestamp=now + timedelta(seconds=3)),
+            Post(body='post 5', author=u2, timestamp=now + timedelta(seconds=4)),
+        ]
+        db.session.add_all(posts)
+        u1.follow(u2)
+        db.session.commit()
+
+        columns = [Post.timestamp, Post.id]
+        page1 = paginate_keyset(u1.followed_posts(), columns, None, 2)
+        assert page1.items == [posts[4], posts[3]]
+        assert page1.has_next is True and page1.has_prev is False
+
+        page2 = paginate_keyset(u1.followed_posts(), columns, page1.next_cursor, 2)
+        assert page2.items == [posts[2], posts[1]]
+        assert page2.has_next is True and page2.has_prev is True
+
+        page3 = paginate_keyset(u1.followed_posts(), columns, page2.next_cursor, 2)
+        assert page3.items == [posts[0]]
+        assert page3.has_next is False and page3.next_cursor is None
+
+        back = paginate_keyset(u1.followed_posts(), columns, page3.prev_cursor, 2)
+        assert back.items == page2.items
+        assert back.has_next is True and back.has_prev is True
+
+        # malformed cursors fall back to the first page
+        assert paginate_keyset(Post.query, columns, 'garbage', 2).items == page1.items
+
+
+def test_aggregate_counts():
+    with app.app_context():
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.add_all([Post(body='one', author=u1), Post(body='two', author=u1)])
+        db.session.commit()
+        u1.follow(u2)
+        u3.follow(u2)
+        db.session.commit()
+
+        counts = User.aggregate_counts([u1.id, u2.id, u3.id])
+        for u in [u1, u2, u3]:
+            assert counts[u.id] == {
+                'post_count': u.posts.count(),
+                'follower_count': u.followers.count(),
+                'followed_count': u.followed.count(),
+            }
+
+
+def test_database_search():
+    with app.app_context():
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the quick brown fox', author=u)
+        p2 = Post(body='a lazy dog', author=u)
+        p3 = Post(body='quick "quoted" dog-walker', author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+
+        posts, total = Post.search('fox', 1, 5)
+        assert posts == [p1] and total == 1
+        posts, total = Post.search('quick dog', 1, 5)
+        assert set(posts) == {p1, p2, p3} and total == 3
+        posts, total = Post.search('quick dog', 2, 2)
+        assert len(posts) == 1 and total == 3
+        # fts5 query syntax in user input is matched literally
+        posts, total = Post.search('"quoted" dog-walker', 1, 5)
+        assert posts == [p3]
+
+        p1.body = 'a slow brown bear'
+        db.session.delete(p2)
+        db.session.commit()
+        assert Post.search('fox', 1, 5) == ([], 0)
+        assert Post.search('lazy', 1, 5) == ([], 0)
+
+
+def test_rate_limit():
+    client = app.test_client()
+    for _ in range(10):
+        assert client.post('/auth/login').status_code == 200
+    response = client.post('/auth/login')
+    assert response.status_code == 429
+    assert 0 < int(response.headers['Retry-After']) <= 6
+    # the limit is on sign in attempts only
+    assert client.get('/auth/login').status_code == 200
+    # clients behind the router have buckets of their own
+    forwarded = {'X-Forwarded-For': '203.0.113.7'}
+    assert client.post('/auth/login', headers=forwarded).status_code == 200
+
+
+def test_post_listing_queries():
+    client = app.test_client()
+    with app.app_context():
+        reader = User(username='reader', email='reader@example.com')
+        db.session.add(reader)
+        db.session.commit()
+        reader_id = reader.id
+    with client.session_transaction() as session:
+        session['_user_id'] = str(reader_id)
+        session['_fresh'] = True
+
+    pages = ['/index', '/explore', '/user/reader', '/search?q=post']
+    counts = {}
+    for authors in (1, 10):
+        with app.app_context():
+            reader = User.query.get(reader_id)
+            for i in range(authors):
+                author = User(username=f'author{authors}-{i}', email=f'{authors}-{i}@example.com')
+                db.session.add_all([author, Post(body='a post', author=author),
+                                    Post(body='a post', author=reader)])
+                reader.follow(author)
+            db.session.commit()
+        for page in pages:
+            # warms the process caches, e.g. the page chrome
+            client.get(page)
+            if page not in counts:
+                with count_queries() as queries:
+                    assert client.get(page).status_code == 200
+                counts[page] = len(queries)
+            else:
+                # ten times the authors on the page, not one more query
+                with assert_max_queries(counts[page]):
+                    assert client.get(page).status_code == 200
+
+
+def test_guess_language():
+    # kana make a text japanese, however many kanji it has
+    assert guess_language('私は東京大学の学生です') == 'ja'
+    assert guess_language('東京大学に行きます') == 'ja'
+    assert guess_language('我是东京大学的学生') == 'zh'
+    assert guess_language('the cat is on the table and it is asleep') == 'en'
+    assert guess_language('ok') is None
+
+
+def test_translate_batch_validation():
+    client = app.test_client()
+    with app.app_context():
+        reader = User(username='reader', email='reader@example.com')
+        db.session.add(reader)
+        db.session.commit()
+        reader_id = reader.id
+    with client.session_transaction() as session:
+        session['_user_id'] = str(reader_id)
+        session['_fresh'] = True
+
+    item = {'id': 1, 'text': 'hola', 'source_language': 'es'}
+    for body in (
+        'not json', [item], {'items': [item]},
+        {'dest_language': 'xx', 'items': [item]},
+        {'dest_language': 'en'},
+        {'dest_language': 'en', 'items': [{'id': 1}]},
+        {'dest_language': 'en', 'items': ['hola']},
+        {'dest_language': 'en', 'items': [item] * (app.config['POSTS_PER_PAGE'] + 1)},
+    ):
+        kwargs = {'data': body} if isinstance(body, str) else {'json': body}
+        response = client.post('/translate/batch', **kwargs)
+        assert response.status_code == 400
+        assert response.get_json()['error'] == 'Bad Request'
+    response = client.post('/translate/batch', json={'dest_language': 'en', 'items': [item]})
+    assert response.status_code == 200
+    assert list(response.get_json()['translations']) == ['1']
+    # ids of both types in one request
+    mixed = [item, dict(item, id='2')]
+    response = client.post('/translate/batch', json={'dest_language': 'en', 'items': mixed})
+    assert response.status_code == 200
+    assert sorted(response.get_json()['translations']) == ['1', '2']
+
+
+def test_timeline():
+    with app.app_context(), fake_redis():
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        # cold: served by followed_posts, and one rebuild job however many page views
+        assert u1.timeline_posts(None, 5) is None
+        timeline.request_rebuild(u1.id)
+        timeline.request_rebuild(u1.id)
+        assert app.task_queues['high'].count == 1
+
+        # empty: a user following nobody gets a warm timeline with no posts
+        u3.rebuild_timeline()
+        assert u3.timeline_posts(None, 5).items == []
+
+        # warm: new posts of followed users are fanned out
+        u1.follow(u2)
+        db.session.commit()
+        p1 = Post(body='post from susan', author=u2, timestamp=datetime.utcnow())
+        db.session.add(p1)
+        db.session.commit()
+        u1.rebuild_timeline()
+        p2 = Post(body='another one', author=u2,
+                  timestamp=datetime.utcnow() + timedelta(seconds=1))
+        db.session.add(p2)
+        db.session.commit()
+        assert u1.timeline_posts(None, 5).items == [p2, p1]
+
+        # a post fanned out while a rebuild reads the database is kept
+        app.redis.delete(f'timeline:{u1.id}')
+        timeline.start_rebuild(u1.id)
+        p3 = Post(body='during the rebuild', author=u2,
+                  timestamp=datetime.utcnow() + timedelta(seconds=2))
+        db.session.add(p3)
+        db.session.commit()
+        timeline.rebuild(u1.id, [(p2.id, p2.timestamp), (p1.id, p1.timestamp)])
+        assert u1.timeline_posts(None, 5).items == [p3, p2, p1]
+
+
+def test_timeline_fan_out_job(monkeypatch):
+    # scores are utc epoch seconds whatever the server's time zone
+    assert timeline._score(datetime(2020, 1, 1)) == 1577836800.0
+    monkeypatch.setitem(app.config, 'TIMELINE_FANOUT_INLINE', 1)
+    with app.app_context(), fake_redis():
+        author = User(username='john', email='john@example.com')
+        fans = [User(username=f'fan{i}', email=f'fan{i}@example.com') for i in range(2)]
+        db.session.add_all([author] + fans)
+        db.session.commit()
+        for fan in fans:
+            fan.follow(author)
+        db.session.commit()
+        for user in [author] + fans:
+            user.rebuild_timeline()
+
+        # more followers than TIMELINE_FANOUT_INLINE: the author's timeline is
+        # updated by the request, the followers' by one job
+        post = Post(body='hello', author=author, timestamp=datetime.utcnow())
+        db.session.add(post)
+        db.session.commit()
+        assert author.timeline_posts(None, 5).items == [post]
+        assert fans[0].timeline_posts(None, 5).items == []
+        jobs = app.task_queues['high'].jobs
+        assert [(job.func_name, job.args) for job in jobs] == \
+            [('app.tasks.fan_out_post', (post.id, author.id, post.timestamp))]
+
+
+def test_follow_graph():
+    with app.app_context(), fake_redis():
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+
+        # cold: loaded from the database by the first check
+        assert not app.redis.exists(f'following:{u1.id}')
+        assert u1.is_following(u2) and not u1.is_following(u3)
+        assert app.redis.exists(f'following:{u1.id}')
+
+        # warm: answered without sql, and kept up to date by follow and unfollow
+        # loads the users the commit expired
+        u1.id, u2.id, u3.id
+        with assert_max_queries(0):
+            assert u1.is_following(u2)
+        u1.follow(u3)
+        u1.unfollow(u2)
+        db.session.commit()
+        u1.id, u2.id, u3.id
+        with assert_max_queries(0):
+            assert u1.is_following(u3) and not u1.is_following(u2)
+
+        # a follow committed while a cold set is loaded isn't overwritten by the
+        # rows read before it
+        app.redis.delete(f'following:{u1.id}')
+        following, version = follow_graph.following_among(u1.id, [u2.id])
+        assert following is None
+        stale = [u3.id]
+        u1.follow(u2)
+        db.session.commit()
+        follow_graph.load(u1.id, version, stale)
+        assert u1.is_following(u2)
+
+
+def test_flush_last_seen(monkeypatch):
+    with app.app_context(), fake_redis():
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        last_seen._recorded.clear()
+        last_seen.record(u1)
+        last_seen.record(u2)
+
+        # a flush that fails leaves the buffer for the next one
+        def fail():
+            raise RuntimeError('database is down')
+        with monkeypatch.context() as patch:
+            patch.setattr(db.session, 'commit', fail)
+            with pytest.raises(RuntimeError):
+                User.flush_last_seen()
+        db.session.rollback()
+        assert app.redis.hlen(last_seen.BUFFER_KEY) == 2
+
+        assert User.flush_last_seen() == 2
+        assert app.redis.hlen(last_seen.BUFFER_KEY) == 0
+        assert u1.last_seen is not None and u2.last_seen is not None
+
+        # a user seen again while a flush runs keeps the newer time buffered
+        last_seen._recorded.clear()
+        last_seen.record(u1)
+        last_seen.record(u2)
+        flushed = last_seen.pending()
+        assert set(flushed) == {u1.id, u2.id}
+        app.redis.hset(last_seen.BUFFER_KEY, u1.id, '4102444800.0')
+        last_seen.clear(flushed)
+        assert last_seen.pending() == {u1.id: b'4102444800.0'}
+
+
+def test_token_auth():
+    client = app.test_client()
+    with app.app_context(), fake_redis():
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        token = u.get_token()
+        db.session.commit()
+        user_id, token_hash = u.id, u.token
+        headers = {'Authorization': f'Bearer {token}'}
+        assert client.get(f'/api/users/{user_id}', headers=headers).status_code == 200
+        # a cached token costs no users query of its own, only the view's lookup
+        with assert_max_queries(1):
+            assert client.get(f'/api/users/{user_id}', headers=headers).status_code == 200
+
+        # unknown tokens are refused without leaving anything in redis
+        unknown = {'Authorization': 'Bearer not-a-token'}
+        assert client.get(f'/api/users/{user_id}', headers=unknown).status_code == 401
+        assert app.redis.keys('auth:token:*') == [f'auth:token:{token_hash}'.encode()]
+
+        # deleting the user evicts the cached lookup
+        db.session.delete(u)
+        db.session.commit()
+        assert not app.redis.exists(f'auth:token:{token_hash}')
+        assert client.get(f'/api/users/{user_id}', headers=headers).status_code == 401
+
+        # a lookup another process still holds is refused once the user is loaded
+        token_cache.set(token_hash, (user_id, datetime.utcnow() + timedelta(hours=1)))
+        response = client.delete('/api/tokens', headers=headers)
+        assert response.status_code == 401
+        assert response.get_json()['error'] == 'Unauthorized'
+
+
+def test_two_level_cache():
+    cache = TwoLevelCache('test', 'SEARCH_CACHE')
+    with app.app_context(), fake_redis():
+        cache.set_many({'a': {'n': 1}, 'b': [2]})
+        assert app.redis.ttl('test:a') == app.config['SEARCH_CACHE_TTL']
+        # served by the process lru, then by redis once the local copy is gone
+        app.redis.delete('test:b')
+        assert cache.get_many(['a', 'b', 'c']) == {'a': {'n': 1}, 'b': [2], 'c': None}
+        cache.local.clear()
+        assert cache.get_many(['a', 'b']) == {'a': {'n': 1}, 'b': None}
+        assert cache.local.get('a') == {'n': 1}
+        cache.delete('a')
+        assert cache.get('a') is None and not app.redis.exists('test:a')
+
+
+def test_search_caches():
+    with app.app_context(), fake_redis():
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the quick brown fox', author=u)
+        p2 = Post(body='a quick dog', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+        ids = [p1.id, p2.id]
+
+        posts, total = Post.search('quick', 1, 5)
+        assert {post.id for post in posts} == set(ids) and total == 2
+        db.session.remove()
+        # normalized query: the page and its rows come from the caches
+        with assert_max_queries(0):
+            posts, total = Post.search('  QUICK ', 1, 5)
+            assert sorted(post.id for post in posts) == ids and total == 2
+        assert {post.body for post in posts} == {'the quick brown fox', 'a quick dog'}
+
+        # a committed change bumps the index version and evicts the changed row
+        version = search.index_version('posts')
+        p1 = Post.query.get(ids[0])
+        p1.body = 'a quick brown bear'
+        db.session.commit()
+        assert search.index_version('posts') == version + 1
+        assert row_cache.get(f'posts:{ids[0]}') is None
+        posts, total = Post.search('quick', 1, 5)
+        assert {post.body for post in posts} == {'a quick brown bear', 'a quick dog'}
+        assert Post.search('fox', 1, 5) == ([], 0)
+
+
+def test_elasticsearch_bulk_refresh():
+    class Client(object):
+        def bulk(self, body, **params):
+            self.params = params
+            return {'errors': False}
+
+    backend = ElasticsearchBackend(Client())
+    actions = [{'op': 'delete', 'index': 'posts', 'id': 1}]
+    # only the indexing of committed changes waits for the refresh, not a reindex
+    backend.bulk(actions)
+    assert backend.client.params == {}
+    backend.bulk(actions, refresh=True)
+    assert backend.client.params == {'refresh': 'wait_for'}
@@ -0,0 +1,64 @@
+from app import chrome, create_app, db, fragments, search, translate
+from app.models import token_cache
+from config import Config
+from contextlib import contextmanager
+from flask import g
+from flask_login import login_user
+import pytest
+
+
+class TestConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    ELASTICSEARCH_URL = None
+    RATELIMIT_BACKEND = 'memory'
+    # will have sqlite use an in-memory db for testing
+
+
+@pytest.fixture(scope='session')
+def app():
+    return create_app(TestConfig)
+
+
+@pytest.fixture(autouse=True)
+def database(app):
+    ''' a fresh database and empty process caches for every test, inside an app context '''
+    for cache in (chrome.chrome_cache, fragments.post_cache, search.result_cache,
+                  search.row_cache, token_cache, translate.translation_cache):
+        cache._local = None
+    with app.app_context():
+        db.create_all()
+        yield
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def fake_redis(app):
+    ''' points app.redis and the task queues at a fakeredis server for the test '''
+    fakeredis = pytest.importorskip('fakeredis')
+    connection = fakeredis.FakeRedis()
+    saved = app.redis, {name: queue.connection for name, queue in app.task_queues.items()}
+    app.redis = connection
+    for queue in app.task_queues.values():
+        queue.connection = connection
+    yield connection
+    app.redis = saved[0]
+    for name, queue in app.task_queues.items():
+        queue.connection = saved[1][name]
+
+
+@pytest.fixture
+def request_as(app):
+    '''
+    returns a context manager factory: request_as(user) runs the block in a request
+    of user, for code that reads current_user or g. every request gets an app
+    context of its own, so g doesn't outlive it, as in a served request.
+    '''
+    @contextmanager
+    def request_as(user):
+        with app.app_context(), app.test_request_context():
+            login_user(user)
+            g.locale = 'en'
+            yield
+    return request_as
@@ -0,0 +1,49 @@
+from app import chrome, db
+from app.models import User
+
+
+def test_chrome_is_loaded_once_and_cached(fake_redis, request_as):
+    u = User(username='john', email='john@example.com')
+    db.session.add(u)
+    db.session.commit()
+
+    with request_as(u):
+        assert chrome.get() == {'new_messages': 0, 'tasks': []}
+    assert chrome.chrome_cache.get(u.id) == {'new_messages': 0, 'tasks': []}
+
+    # later requests are served by the cache, not by chrome_state
+    chrome.chrome_cache.set(u.id, {'new_messages': 7, 'tasks': []})
+    with request_as(u):
+        assert chrome.get()['new_messages'] == 7
+        # and within a request by g, whatever happens to the cache
+        chrome.chrome_cache.delete(u.id)
+        assert chrome.get()['new_messages'] == 7
+
+
+def test_notification_invalidates_the_chrome(fake_redis, request_as):
+    u = User(username='john', email='john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    with request_as(u):
+        chrome.get()
+
+    u.add_notification('unread_message_count', 1)
+    # dropped only once the notification commits
+    assert chrome.chrome_cache.get(u.id) is not None
+    db.session.commit()
+    assert chrome.chrome_cache.get(u.id) is None
+    assert not fake_redis.exists(f'chrome:{u.id}')
+
+
+def test_launched_task_shows_in_the_chrome(fake_redis, request_as):
+    u = User(username='john', email='john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    with request_as(u):
+        assert chrome.get()['tasks'] == []
+
+    task = u.launch_task('export_posts', 'Exporting posts...', 'http://localhost/export')
+    db.session.commit()
+    with request_as(u):
+        tasks = chrome.get()['tasks']
+    assert [(t['id'], t['description']) for t in tasks] == [(task.id, 'Exporting posts...')]
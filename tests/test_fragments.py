@@ -0,0 +1,51 @@
+from app import db, fragments
+from app.models import Post, User
+from datetime import datetime
+
+
+def _posts():
+    u = User(username='john', email='john@example.com')
+    posts = [Post(body=f'post {i}', author=u, timestamp=datetime.utcnow()) for i in range(2)]
+    db.session.add_all([u] + posts)
+    db.session.commit()
+    return u, posts
+
+
+def test_render_posts_caches_each_fragment(fake_redis, request_as, monkeypatch):
+    u, posts = _posts()
+    rendered = []
+    render_template = fragments.render_template
+
+    def render(*args, **kwargs):
+        rendered.append(kwargs['post'].id)
+        return render_template(*args, **kwargs)
+    monkeypatch.setattr(fragments, 'render_template', render)
+
+    with request_as(u):
+        html = fragments.render_posts(posts)
+    assert 'post 0' in html and 'post 1' in html
+    assert html.index('post 0') < html.index('post 1')
+    assert sorted(rendered) == sorted(post.id for post in posts)
+
+    # a hit renders nothing, and is shared with other processes through redis
+    fragments.post_cache.local.clear()
+    with request_as(u):
+        html = fragments.render_posts(posts[::-1])
+    assert html.index('post 1') < html.index('post 0')
+    assert len(rendered) == 2
+    assert len(fake_redis.keys('fragment:post:*')) == 2
+
+
+def test_render_posts_rerenders_on_key_changes(fake_redis, request_as):
+    u, posts = _posts()
+    with request_as(u):
+        assert 'Translate' not in fragments.render_posts(posts)
+
+    # the language detected later and a renamed author make new fragments
+    posts[0].language = 'es'
+    u.username = 'johnny'
+    db.session.commit()
+    with request_as(u):
+        html = fragments.render_posts(posts)
+    assert html.count('Translate') == 1
+    assert 'johnny' in html and '/user/john"' not in html
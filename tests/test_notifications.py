@@ -0,0 +1,80 @@
+from app import db, push
+from app.models import Notification, User
+import json
+import time
+
+
+def test_upsert_keeps_one_notification_per_name(fake_redis):
+    u = User(username='john', email='john@example.com')
+    db.session.add(u)
+    db.session.commit()
+
+    u.add_notification('unread_message_count', 1)
+    u.add_notification('unread_message_count', 2)
+    u.add_notification('task_progress', {'task_id': 'a', 'progress': 50})
+    db.session.commit()
+    rows = {n.name: n.get_data() for n in u.notifications}
+    assert rows == {'unread_message_count': 2, 'task_progress': {'task_id': 'a', 'progress': 50}}
+
+    # the committed values are in the latest-state hash, which isn't complete yet
+    assert json.loads(fake_redis.hget(push.latest_key(u.id), 'unread_message_count'))['data'] == 2
+    assert push.latest(u.id) is None
+
+
+def test_rolled_back_notification_is_not_published(fake_redis):
+    u = User(username='john', email='john@example.com')
+    db.session.add(u)
+    db.session.commit()
+
+    u.add_notification('unread_message_count', 1)
+    db.session.rollback()
+    assert not fake_redis.exists(push.latest_key(u.id))
+    assert Notification.query.count() == 0
+
+
+def test_fill_keeps_notifications_published_meanwhile(fake_redis):
+    u = User(username='john', email='john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    u.add_notification('unread_message_count', 1)
+    db.session.commit()
+    stale = [n.to_dict() for n in u.notifications]
+
+    # a newer value is published after the rows were read
+    u.add_notification('unread_message_count', 2)
+    db.session.commit()
+    push.fill(u.id, stale)
+    latest = push.latest(u.id)
+    assert [n['data'] for n in latest] == [2]
+
+
+def test_sweep_drops_old_notifications_and_their_hash(fake_redis):
+    u = User(username='john', email='john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    u.add_notification('unread_message_count', 1)
+    db.session.commit()
+    push.fill(u.id, [n.to_dict() for n in u.notifications])
+
+    assert Notification.sweep(time.time() - 3600) == 0
+    assert push.latest(u.id) is not None
+    assert Notification.sweep(time.time() + 1) == 1
+    assert Notification.query.count() == 0
+    assert push.latest(u.id) is None
+
+
+def test_notifications_route_fills_the_hash(app, fake_redis):
+    u = User(username='john', email='john@example.com')
+    db.session.add(u)
+    db.session.commit()
+    u.add_notification('unread_message_count', 3)
+    db.session.commit()
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(u.id)
+        session['_fresh'] = True
+
+    response = client.get('/notifications?since=0')
+    assert [n['data'] for n in response.get_json()] == [3]
+    # served from the now complete hash afterwards
+    assert [n['data'] for n in push.latest(u.id)] == [3]
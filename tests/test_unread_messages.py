@@ -0,0 +1,63 @@
+from app import db, push
+from app.models import Message, User
+from datetime import datetime, timedelta
+
+
+def _users():
+    sender = User(username='john', email='john@example.com')
+    recipient = User(username='susan', email='susan@example.com')
+    db.session.add_all([sender, recipient])
+    db.session.commit()
+    return sender, recipient
+
+
+def test_unread_counter_increments_and_resets():
+    sender, recipient = _users()
+    assert recipient.new_messages() == 0
+    for count in (1, 2):
+        db.session.add(Message(author=sender, recipient=recipient, body='hi'))
+        assert recipient.add_unread_message() == count
+        db.session.commit()
+    assert User.query.get(recipient.id).new_messages() == 2
+
+    recipient.read_messages()
+    db.session.commit()
+    assert User.query.get(recipient.id).new_messages() == 0
+
+
+def test_unread_counter_increment_is_atomic():
+    sender, recipient = _users()
+    # the UPDATE adds to the stored value, not to the one this session loaded
+    db.session.execute(User.__table__.update().where(User.id == recipient.id)
+                       .values(unread_message_count=5))
+    assert recipient.add_unread_message() == 6
+    db.session.commit()
+    assert User.query.get(recipient.id).new_messages() == 6
+
+
+def test_reconcile_fixes_drifted_counters():
+    sender, recipient = _users()
+    recipient.last_message_read_time = datetime.utcnow() - timedelta(hours=1)
+    db.session.add_all([
+        Message(author=sender, recipient=recipient, body='read',
+                timestamp=datetime.utcnow() - timedelta(hours=2)),
+        Message(author=sender, recipient=recipient, body='unread'),
+    ])
+    recipient.unread_message_count = 5
+    db.session.commit()
+
+    # only the drifted counter is written: the sender's 0 is already right
+    assert User.reconcile_unread_counts() == 1
+    assert User.query.get(recipient.id).new_messages() == 1
+    assert User.query.get(sender.id).new_messages() == 0
+    assert User.reconcile_unread_counts() == 0
+
+
+def test_unread_count_is_pushed_to_the_recipient(fake_redis):
+    sender, recipient = _users()
+    db.session.add(Message(author=sender, recipient=recipient, body='hi'))
+    recipient.add_notification('unread_message_count', recipient.add_unread_message())
+    db.session.commit()
+    push.fill(recipient.id, [])
+    assert [(n['name'], n['data']) for n in push.latest(recipient.id)] == \
+        [('unread_message_count', 1)]
@@ -1,9 +1,15 @@
+from config import Config
 import os
 import redis
 from rq import Queue, Connection, Worker
+import signal
+import sys
+import time
 
 
-listen = ['flask_blog-tasks']
+# highest priority first: a worker only takes a job from a queue when the ones
+# before it are empty
+listen = list(Config.TASK_QUEUES.values())
 
 redis_url = os.getenv('REDISTOGO_URL', None)
 if not redis_url:
@@ -11,7 +17,90 @@ if not redis_url:
 
 conn = redis.from_url(redis_url)
 
-if __name__ == '__main__':
+
+def start_periodic_jobs():
+    '''
+    starts the periodic jobs: last_seen flush, notification sweep and unread recount.
+    each run schedules the next one under an id made of its time (see
+    app.tasks._schedule_next), so chains started by several workers collapse into one
+    '''
+    low = Queue(Config.TASK_QUEUES['low'])
+    low.enqueue('app.tasks.flush_last_seen', job_id='flush_last_seen')
+    low.enqueue('app.tasks.sweep_notifications', job_id='sweep_notifications')
+    low.enqueue('app.tasks.reconcile_unread_counts', job_id='reconcile_unread_counts')
+
+
+def work():
+    ''' runs one worker in this process until it is told to stop '''
+    from app import db
+    # connections opened before the fork must not be shared with the parent
+    db.engine.dispose()
     with Connection(conn):
         worker = Worker(map(Queue, listen))
-        worker.work()
+        worker.work(with_scheduler=True)
+
+
+def spawn():
+    pid = os.fork()
+    if pid == 0:
+        # the child gets default signal handling back, so rq can install its own
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            work()
+        finally:
+            os._exit(0)
+    return pid
+
+
+def supervise(count):
+    '''
+    forks count workers and restarts any that dies, until SIGTERM or SIGINT, which
+    is passed on to the workers (rq finishes the current job on the first one).
+
+    the app is imported once here, before forking: the workers and the work horses
+    they fork per job share its memory copy-on-write instead of each building it.
+
+    :param count:       number of worker processes
+    :returns:
+    '''
+    import app.tasks  # noqa: F401
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    workers = set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(count):
+        workers.add(spawn())
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        workers.discard(pid)
+        if not stopping:
+            print(f'worker {pid} exited with status {status}, restarting', file=sys.stderr)
+            # don't spin when workers die right away, e.g. redis is unreachable
+            time.sleep(1)
+            workers.add(spawn())
+
+
+if __name__ == '__main__':
+    # python worker.py [number of workers], RQ_WORKERS or the cpu count by default
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else Config.RQ_WORKERS or os.cpu_count()
+    with Connection(conn):
+        start_periodic_jobs()
+    supervise(count)